@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк страниц списка пользователей в админке: OFFSET против курсора по id
+
+Старый способ: ORDER BY id DESC LIMIT 10 OFFSET (N-1)*10 плюс COUNT(*) на
+каждой странице. Новый: WHERE id < курсор ORDER BY id DESC LIMIT 10 и
+общее число из таблицы counters.
+
+Запуск: python bench_admin_users.py [--users 1000000]
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from migrations import migrate
+
+PER_PAGE = 10
+COLUMNS = "id, telegram_id, username, first_name, is_active, created_at"
+REPEAT = 20
+
+
+def fill(path: str, users: int):
+    migrate(path)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)",
+        ((100000 + i, f"user{i}", "Имя") for i in range(users))
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> float:
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - started) / REPEAT
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"Заполнение: {args.users} пользователей...")
+        fill(path, args.users)
+        conn = sqlite3.connect(path)
+        max_id = conn.execute("SELECT MAX(id) FROM users").fetchone()[0]
+        last_page = -(-args.users // PER_PAGE)
+
+        pages = [1, 10, 100, 1_000, 10_000, 100_000, last_page]
+        pages = sorted({p for p in pages if p <= last_page})
+
+        print(f"\n{'страница':>10}{'OFFSET+COUNT, мс':>20}{'курсор+counters, мс':>22}")
+        for page in pages:
+            offset = (page - 1) * PER_PAGE
+            old = timed(conn, f"SELECT {COLUMNS} FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (PER_PAGE, offset))
+            old += timed(conn, "SELECT COUNT(*) FROM users")
+            # Курсор - id последней строки предыдущей страницы (id без пропусков)
+            cursor_id = max_id - offset + 1
+            new = timed(conn, f"SELECT {COLUMNS} FROM users WHERE id < ? ORDER BY id DESC LIMIT ?", (cursor_id, PER_PAGE))
+            new += timed(conn, "SELECT name, value FROM counters")
+            print(f"{page:>10}{old * 1000:>20.3f}{new * 1000:>22.3f}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
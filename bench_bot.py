@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Сквозной бенчмарк бота через Dispatcher.feed_update
+
+Синтетические апдейты (/start, buy_vpn, check_*, status, админка) идут
+через настоящий dp со всеми middleware. Вызовы Telegram API перехватывает
+фальшивая сессия (ничего не уходит в сеть), Platega заменена локальным
+эмулятором с настраиваемой задержкой, база - временный файл. Для каждого
+сценария считаются апдейты/с, p50/p95/p99 времени обработки, запросы к
+БД и вызовы Telegram на апдейт. Для buy_vpn отдельно меряется время до
+подмены сообщения ссылкой на оплату (счет создается в фоне).
+
+Результаты пишутся в JSON (по умолчанию bench_results/bot-<время>.json);
+с --compare печатается разница с прошлым прогоном.
+
+Запуск: python bench_bot.py [--updates 500] [--concurrency 50] [--latency-ms 50]
+"""
+
+import os
+import tempfile
+
+# Окружение бенчмарка задается до импорта main_bot: он читает конфигурацию при импорте
+_workdir = tempfile.mkdtemp(prefix="bench_bot_")
+BENCH_ENV = {
+    'DB_PATH': os.path.join(_workdir, 'bench.db'),
+    'BOT_TOKEN': '123456:BENCH',
+    'ADMIN_ID': '1',
+    'BOT_MODE': 'polling',
+    'BOT_LOG_FILE': '',
+    'BOT_METRICS_PORT': '0',
+    'LOG_LEVEL': 'WARNING',
+    'OUTBOX_SOCKET': os.path.join(_workdir, 'outbox.sock'),
+    # Фоновые циклы не должны попадать в замеры сценариев
+    'RECONCILE_INTERVAL': '3600',
+    'OUTBOX_POLL_INTERVAL': '3600',
+    'USER_FLUSH_INTERVAL': '3600',
+    'PROFILE_UPDATES': '0',
+}
+os.environ.update(BENCH_ENV)
+
+import argparse
+import asyncio
+import datetime
+import json
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import time
+from collections import Counter
+
+from aiogram import types
+from aiogram.methods import EditMessageText, SendMessage
+
+import main_bot
+from bench_platega import start_stub
+from metrics import DB_LATENCY
+
+ADMIN_ID = main_bot.ADMIN_ID
+SEEDED_USERS = 1000
+FIRST_USER_ID = 10_000_000
+
+
+class FakeSession:
+    """Подменяет bot.session.make_request: считает вызовы и отвечает как Telegram"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.calls = Counter()
+        self._message_id = 0
+        # chat_id -> future, который завершается при EditMessageText в этот чат
+        self.edit_waiters: dict = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            chat_id = method.chat_id
+            if isinstance(method, EditMessageText):
+                waiter = self.edit_waiters.pop(chat_id, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(time.perf_counter())
+            return self.message(chat_id, method.text)
+        return True
+
+    def message(self, chat_id: int, text: str = "") -> types.Message:
+        self._message_id += 1
+        return types.Message.model_validate({
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 123456, 'is_bot': True, 'first_name': 'Bench bot'},
+            'text': text,
+        }, context={'bot': self.bot})
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def _validate(self, payload: dict) -> types.Update:
+        self.update_id += 1
+        return types.Update.model_validate({'update_id': self.update_id, **payload}, context={'bot': self.bot})
+
+    def command(self, user_id: int, text: str) -> types.Update:
+        command = text.split()[0]
+        return self._validate({'message': {
+            'message_id': self.update_id + 1,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }})
+
+    def callback(self, user_id: int, data: str) -> types.Update:
+        return self._validate({'callback_query': {
+            'id': str(self.update_id + 1),
+            'from': self._user(user_id),
+            'chat_instance': 'bench',
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 123456, 'is_bot': True, 'first_name': 'Bench bot'},
+                'text': 'menu',
+            },
+        }})
+
+
+def seed(path: str, users: int) -> dict:
+    """Пользователи для /start и списка админки, платежи для check_* и status"""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)",
+            [(FIRST_USER_ID + i, f'user{FIRST_USER_ID + i}', f'User{FIRST_USER_ID + i}') for i in range(users)]
+        )
+        orders = {'pending': [], 'success': []}
+        rows = []
+        for i in range(users):
+            status = 'success' if i % 2 else 'pending'
+            order_id = f'bench_{i}'
+            orders[status].append((FIRST_USER_ID + i, order_id))
+            rows.append((FIRST_USER_ID + i, order_id, 100, status, f'token_{i}'))
+        conn.executemany(
+            "INSERT INTO payments (telegram_id, order_id, amount, status, vpn_token) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+    conn.close()
+    return orders
+
+
+def percentiles(timings: list) -> dict:
+    if len(timings) < 2:
+        value = round(timings[0] * 1000, 2) if timings else None
+        return {'p50_ms': value, 'p95_ms': value, 'p99_ms': value}
+    cuts = statistics.quantiles(timings, n=100, method='inclusive')
+    return {
+        'p50_ms': round(cuts[49] * 1000, 2),
+        'p95_ms': round(cuts[94] * 1000, 2),
+        'p99_ms': round(cuts[98] * 1000, 2),
+    }
+
+
+def db_queries() -> int:
+    return sum(entry[2] for entry in DB_LATENCY._values.values())
+
+
+class Bench:
+    def __init__(self, session: FakeSession, factory: UpdateFactory, updates: int, concurrency: int):
+        self.session = session
+        self.factory = factory
+        self.updates = updates
+        self.concurrency = concurrency
+        self.next_user = FIRST_USER_ID + SEEDED_USERS
+        self.results: dict = {}
+
+    def new_user(self) -> int:
+        self.next_user += 1
+        return self.next_user
+
+    async def scenario(self, name: str, handler: str, make_update, after=None, track_edit: bool = False):
+        """Прогоняет self.updates апдейтов, не больше concurrency одновременно"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timings, edit_timings = [], []
+        waiters = []
+        updates = [make_update(i) for i in range(self.updates)]
+
+        async def feed(update: types.Update):
+            async with semaphore:
+                started = time.perf_counter()
+                if track_edit:
+                    chat_id = update.callback_query.from_user.id
+                    waiter = asyncio.get_running_loop().create_future()
+                    self.session.edit_waiters[chat_id] = waiter
+                    waiters.append((started, waiter))
+                await main_bot.dp.feed_update(main_bot.bot, update)
+                timings.append(time.perf_counter() - started)
+
+        queries, calls = db_queries(), self.session.total()
+        started = time.perf_counter()
+        await asyncio.gather(*(feed(update) for update in updates))
+        if track_edit:
+            for begun, waiter in waiters:
+                edit_timings.append(await waiter - begun)
+        if after is not None:
+            await after()
+        elapsed = time.perf_counter() - started
+
+        result = {
+            'handler': handler,
+            'updates': len(updates),
+            'seconds': round(elapsed, 3),
+            'updates_per_sec': round(len(updates) / elapsed, 1),
+            **percentiles(timings),
+            'db_queries_per_update': round((db_queries() - queries) / len(updates), 2),
+            'telegram_calls_per_update': round((self.session.total() - calls) / len(updates), 2),
+        }
+        if track_edit:
+            result['invoice_shown'] = percentiles(edit_timings)
+        self.results[name] = result
+        print(
+            f"{name:<16} {result['updates_per_sec']:>8} upd/s | p50 {result['p50_ms']:>7} мс | "
+            f"p95 {result['p95_ms']:>7} мс | p99 {result['p99_ms']:>7} мс | "
+            f"БД {result['db_queries_per_update']:>5}/upd | Telegram {result['telegram_calls_per_update']:>4}/upd"
+        )
+
+    async def run_all(self, orders: dict):
+        factory = self.factory
+        known = [FIRST_USER_ID + i for i in range(SEEDED_USERS)]
+
+        await self.scenario('start_new', 'cmd_start', lambda i: factory.command(self.new_user(), '/start'),
+                            after=main_bot.user_registry.flush)
+        await self.scenario('start_known', 'cmd_start',
+                            lambda i: factory.command(known[i % len(known)], '/start'),
+                            after=main_bot.user_registry.flush)
+        await self.scenario('buy_vpn', 'process_buy', lambda i: factory.callback(self.new_user(), 'buy_vpn'),
+                            track_edit=True)
+        pending, success = orders['pending'], orders['success']
+        await self.scenario('check_pending', 'check_payment_status',
+                            lambda i: factory.callback(*self._order(pending, i)))
+        await self.scenario('check_success', 'check_payment_status',
+                            lambda i: factory.callback(*self._order(success, i)))
+        await self.scenario('status', 'show_status', lambda i: factory.callback(known[i % len(known)], 'status'))
+        await self.scenario('admin', 'admin_panel', lambda i: factory.command(ADMIN_ID, '/admin'))
+        await self.scenario('admin_stats', 'send_admin_stats', lambda i: factory.callback(ADMIN_ID, 'admin_stats'))
+        await self.scenario('admin_users', 'send_users_list', lambda i: factory.callback(ADMIN_ID, 'admin_users_f'))
+        await self.scenario('admin_refresh', 'refresh_admin_panel',
+                            lambda i: factory.callback(ADMIN_ID, 'admin_refresh'))
+
+    @staticmethod
+    def _order(orders: list, i: int) -> tuple:
+        telegram_id, order_id = orders[i % len(orders)]
+        return telegram_id, f'check_{order_id}'
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(current: dict, path: str):
+    with open(path, encoding='utf-8') as f:
+        previous = json.load(f)['scenarios']
+    print(f"\nСравнение с {path}:")
+    for name, result in current.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        speed = (result['updates_per_sec'] / old['updates_per_sec'] - 1) * 100 if old['updates_per_sec'] else 0
+        print(f"{name:<16} upd/s {speed:+6.1f}% | p95 {old['p95_ms']} -> {result['p95_ms']} мс | "
+              f"БД {old['db_queries_per_update']} -> {result['db_queries_per_update']}/upd")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500, help="апдейтов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="задержка ответа эмулятора Platega")
+    parser.add_argument("--output", help="файл результатов (по умолчанию bench_results/bot-<время>.json)")
+    parser.add_argument("--compare", help="прошлый файл результатов для сравнения")
+    args = parser.parse_args()
+
+    orders = seed(BENCH_ENV['DB_PATH'], SEEDED_USERS)
+    stub, base_url = await start_stub(args.latency_ms / 1000)
+    bot = main_bot.bot
+    session = FakeSession(bot)
+    bot.session.make_request = session.make_request
+    main_bot.platega.base_url = base_url
+
+    await main_bot.dp.emit_startup(bot=bot)
+    bench = Bench(session, UpdateFactory(bot), args.updates, args.concurrency)
+    print(f"Апдейтов на сценарий: {args.updates}, параллельно: {args.concurrency}, "
+          f"задержка Platega: {args.latency_ms:.0f} мс")
+    try:
+        await bench.run_all(orders)
+    finally:
+        await main_bot.dp.emit_shutdown(bot=bot)
+        await stub.cleanup()
+        shutil.rmtree(_workdir, ignore_errors=True)
+
+    total_updates = sum(result['updates'] for result in bench.results.values())
+    total_seconds = sum(result['seconds'] for result in bench.results.values())
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'config': {
+            'updates': args.updates,
+            'concurrency': args.concurrency,
+            'platega_latency_ms': args.latency_ms,
+            'seeded_users': SEEDED_USERS,
+        },
+        'total': {'updates': total_updates, 'updates_per_sec': round(total_updates / total_seconds, 1)},
+        'telegram_calls': dict(session.calls),
+        'throttled': dict(main_bot.throttling.rejected),
+        'scenarios': bench.results,
+    }
+
+    output = args.output or os.path.join(
+        'bench_results', f"bot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nВсего: {total_updates} апдейтов, {report['total']['updates_per_sec']} upd/s. Результаты: {output}")
+
+    if args.compare:
+        compare(bench.results, args.compare)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест записи callback Platega: по одному коммиту против пачек
+
+Старая схема: каждый callback открывает соединение, делает SELECT и
+UPDATE, коммитит и закрывает соединение (параллельно в потоках, как
+синхронные обработчики). Новая схема: CallbackWriter с групповым
+коммитом. Для обеих показываются callback/с, p50/p99 времени до ответа
+и число ошибок (например, database is locked).
+
+Запуск: python bench_callbacks.py [--callbacks 5000] [--concurrency 64]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from callback_writer import CallbackWriter
+from database import Database
+from migrations import migrate
+
+
+def fill(path: str, callbacks: int):
+    migrate(path)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO payments (telegram_id, order_id, amount, vpn_token) VALUES (?, ?, ?, ?)",
+        ((100000 + i, f"vpn_{i}", 150, f"tok_{i}") for i in range(callbacks))
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_callback(path: str, order_id: str):
+    """Обработка callback до групповой записи"""
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM payments WHERE order_id = ?", (order_id,))
+        if cursor.fetchone():
+            cursor.execute(
+                "UPDATE payments SET status = ?, completed_at = CURRENT_TIMESTAMP WHERE order_id = ?",
+                ("success", order_id)
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
+
+async def run_legacy(path: str, callbacks: int, concurrency: int) -> tuple:
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    timings, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await loop.run_in_executor(executor, legacy_callback, path, f"vpn_{i}")
+            except sqlite3.Error:
+                errors += 1
+            timings.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(callbacks)))
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+    return timings, errors, elapsed
+
+
+async def run_batched(path: str, callbacks: int, concurrency: int) -> tuple:
+    db = Database(path)
+    writer = CallbackWriter(db)
+    writer.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    timings, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await writer.submit(f"vpn_{i}", "success", f"tx_{i}")
+            except Exception:
+                errors += 1
+            timings.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(callbacks)))
+    elapsed = time.perf_counter() - started
+    await writer.stop()
+    await db.close()
+    print(f"  пачек: {writer.stats['batches']}, максимальная пачка: {writer.stats['max_batch']}")
+    return timings, errors, elapsed
+
+
+def describe(name: str, callbacks: int, result: tuple) -> str:
+    timings, errors, elapsed = result
+    ordered = sorted(timings)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[max(int(len(ordered) * 0.99) - 1, 0)]
+    return (
+        f"{name:<18}{callbacks / elapsed:>10.0f} cb/с | p50 {p50 * 1000:7.2f} мс | "
+        f"p99 {p99 * 1000:8.2f} мс | ошибок {errors}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--callbacks", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных callback")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        batched_path = os.path.join(tmp, "batched.db")
+        fill(legacy_path, args.callbacks)
+        fill(batched_path, args.callbacks)
+
+        print(f"Callback: {args.callbacks}, одновременно: {args.concurrency}")
+        legacy = await run_legacy(legacy_path, args.callbacks, args.concurrency)
+        batched = await run_batched(batched_path, args.callbacks, args.concurrency)
+
+    print(describe("коммит на callback", args.callbacks, legacy))
+    print(describe("групповой коммит", args.callbacks, batched))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк запросов show_status и админки до и после индексов миграции 3
+
+Запуск: python bench_indexes.py [--payments 1000000] [--users 100000]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from migrations import migrate
+
+STATUS_QUERY = "SELECT COUNT(*) as total_payments, SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END) as successful_payments FROM payments WHERE telegram_id = ?"
+
+ADMIN_QUERIES = {
+    "users total": "SELECT COUNT(*) FROM users",
+    "users active": "SELECT COUNT(*) FROM users WHERE is_active = 1",
+    "payments total": "SELECT COUNT(*) FROM payments",
+    "payments success": "SELECT COUNT(*) FROM payments WHERE status='success'",
+    "payments pending": "SELECT COUNT(*) FROM payments WHERE status='pending'",
+    "revenue": "SELECT SUM(amount) FROM payments WHERE status='success'",
+}
+
+ADMIN_REPEAT = 5
+
+
+def fill(path: str, payments: int, users: int):
+    """Создает базу со схемой до индексов и заполняет ее синтетическими данными"""
+    migrate(path, target=2)
+    conn = sqlite3.connect(path)
+    rnd = random.Random(42)
+    conn.executemany(
+        "INSERT INTO users (telegram_id, username, first_name, is_active) VALUES (?, ?, ?, ?)",
+        ((100000 + i, f"user{i}", "Имя", 1 if rnd.random() < 0.2 else 0) for i in range(users))
+    )
+    statuses = ["success"] * 6 + ["pending"] * 3 + ["failed"]
+    conn.executemany(
+        "INSERT INTO payments (telegram_id, order_id, amount, status, vpn_token) VALUES (?, ?, ?, ?, ?)",
+        ((100000 + rnd.randrange(users), f"vpn_{i}", 150, rnd.choice(statuses), f"tok_{i}") for i in range(payments))
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(path: str, users: int, repeat: int) -> dict:
+    conn = sqlite3.connect(path)
+    rnd = random.Random(7)
+    results = {}
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(STATUS_QUERY, (100000 + rnd.randrange(users),)).fetchone()
+    results["show_status"] = (time.perf_counter() - started) / repeat
+
+    admin_total = 0.0
+    for name, sql in ADMIN_QUERIES.items():
+        started = time.perf_counter()
+        for _ in range(ADMIN_REPEAT):
+            conn.execute(sql).fetchone()
+        elapsed = (time.perf_counter() - started) / ADMIN_REPEAT
+        results[name] = elapsed
+        admin_total += elapsed
+    results["admin panel (all)"] = admin_total
+
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--payments", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=200, help="запросов show_status на замер")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"Заполнение: {args.payments} платежей, {args.users} пользователей...")
+        fill(path, args.payments, args.users)
+
+        before = measure(path, args.users, args.repeat)
+        started = time.perf_counter()
+        migrate(path)
+        migration_time = time.perf_counter() - started
+        after = measure(path, args.users, args.repeat)
+
+    print(f"Миграция до последней версии: {migration_time:.2f} с\n")
+    print(f"{'запрос':<22}{'до, мс':>12}{'после, мс':>12}{'ускорение':>12}")
+    for name in before:
+        b, a = before[name] * 1000, after[name] * 1000
+        print(f"{name:<22}{b:>12.3f}{a:>12.3f}{b / a if a else float('inf'):>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
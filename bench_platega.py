@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк PlategaAPI против локального эмулятора Platega
+
+Сравнивает старую схему (новая ClientSession на каждый вызов) с общей
+сессией PlategaAPI. Эмулятор работает по HTTP на localhost, поэтому
+экономия показана без TLS; на реальном https://app.platega.io к ней
+добавляется TLS-рукопожатие.
+
+Запуск: python bench_platega.py [--calls 200] [--latency-ms 0]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from platega import PlategaAPI
+from platega_emulator import start_emulator
+
+
+async def start_stub(latency: float = 0.0, port: int = 0) -> tuple:
+    """Эмулятор Platega без callback; возвращает (runner, base_url)"""
+    runner, _, base_url = await start_emulator(port=port, callback_url=None, latency=latency)
+    return runner, base_url
+
+
+async def run_fresh_session(base_url: str, calls: int) -> list:
+    """Как раньше: новая сессия и соединение на каждый вызов"""
+    timings = []
+    for i in range(calls):
+        api = PlategaAPI(base_url=base_url)
+        started = time.perf_counter()
+        await api.create_payment(100, f"bench_{i}", "bench")
+        await api.close()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run_pooled_session(base_url: str, calls: int) -> list:
+    """Общая сессия с keep-alive и кэшем DNS"""
+    api = PlategaAPI(base_url=base_url)
+    await api.start()
+    timings = []
+    for i in range(calls):
+        started = time.perf_counter()
+        await api.create_payment(100, f"bench_{i}", "bench")
+        timings.append(time.perf_counter() - started)
+    await api.close()
+    return timings
+
+
+def describe(timings: list) -> str:
+    ordered = sorted(timings)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    return f"среднее {statistics.mean(ordered) * 1000:7.2f} мс | p50 {statistics.median(ordered) * 1000:7.2f} мс | p95 {p95 * 1000:7.2f} мс"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа эмулятора")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    runner, base_url = await start_stub(args.latency_ms / 1000)
+    try:
+        fresh = await run_fresh_session(base_url, args.calls)
+        pooled = await run_pooled_session(base_url, args.calls)
+    finally:
+        await runner.cleanup()
+
+    print(f"Вызовов create_payment: {args.calls}, эмулятор {base_url}")
+    print(f"новая сессия на вызов: {describe(fresh)}")
+    print(f"общая сессия:          {describe(pooled)}")
+    saved = statistics.mean(fresh) - statistics.mean(pooled)
+    print(f"экономия на вызов:     {saved * 1000:.2f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест web_server.py с учетом блокировок SQLite
+
+Сценарии:
+  sale_burst  - наплыв callback Platega во время распродажи (с повторами
+                доставки), пока "бот" в соседнем процессе создает счета;
+  vpn_refresh - клиенты VPN обновляют страницу /vpn/{token} (часть с
+                If-None-Match, часть с несуществующими токенами);
+  site        - главная страница, статика /static/* и /assets/*;
+  mixed       - все сразу.
+
+Режимы: asgi - приложение в этом же процессе через httpx.ASGITransport
+(нужен httpx); uvicorn - настоящий сервер на localhost (--workers N)
+или уже запущенный (--url вместе с --db его базы). Для каждого сценария
+печатаются запросы/с, p50/p95/p99 и доля ошибок по типам запросов, а
+также повторы из-за блокировки SQLite, время ожидания и ошибки
+"database is locked" - у веб-сервера (из /metrics) и у процесса бота.
+С несколькими воркерами uvicorn /metrics отдает счетчики того воркера,
+который ответил, поэтому точные цифры блокировок - при --workers 1.
+
+Запуск: python bench_web.py [--mode asgi|uvicorn] [--workers 1] [--requests 2000]
+        [--concurrency 100] [--bot-rate 50] [--scenario all] [--output bench_results/web.json]
+"""
+
+import os
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import random
+import re
+import secrets
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Optional
+
+import aiohttp
+
+from migrations import migrate
+
+SCENARIOS = ('sale_burst', 'vpn_refresh', 'site', 'mixed')
+SEEDED_TOKENS = 2000
+CONTENTION_METRICS = ('db_busy_retries_total', 'db_busy_wait_seconds_total', 'db_locked_total')
+
+
+# ===== ДАННЫЕ =====
+class Orders:
+    """Выдает еще не оплаченные заказы (у каждого сценария свои)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.next_id = 0
+
+    def create(self, count: int) -> list:
+        first, self.next_id = self.next_id, self.next_id + count
+        orders = [f"bench_order_{i}" for i in range(first, first + count)]
+        conn = sqlite3.connect(self.path, timeout=30)
+        with conn:
+            conn.executemany(
+                "INSERT INTO payments (telegram_id, order_id, amount, vpn_token) VALUES (?, ?, ?, ?)",
+                ((500000 + i, order_id, 100, f"pending_{order_id}") for i, order_id in enumerate(orders))
+            )
+        conn.close()
+        return orders
+
+
+def seed(path: str):
+    """Пользователи с оплаченными подписками для /vpn/{token}"""
+    migrate(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)",
+            ((100000 + i, f"user{i}", f"User{i}") for i in range(SEEDED_TOKENS))
+        )
+        conn.executemany(
+            "INSERT INTO payments (telegram_id, order_id, amount, status, vpn_token) VALUES (?, ?, 100, 'success', ?)",
+            ((100000 + i, f"paid_{i}", f"token_{i}") for i in range(SEEDED_TOKENS))
+        )
+    conn.close()
+
+
+# ===== ПРОЦЕСС "БОТА" =====
+def bot_writer(path: str, rate: float, ready, stop, results):
+    """Пишет в ту же базу, что и бот: счета (INSERT + UPDATE) и пачки пользователей"""
+    os.environ['DB_PATH'] = path
+    from database import Database, PaymentsRepository, UsersRepository
+    from metrics import DB_BUSY_RETRIES, DB_BUSY_WAIT, DB_LOCKED
+
+    async def main():
+        db = Database(path)
+        payments, users = PaymentsRepository(db), UsersRepository(db)
+        stats = {'invoices': 0, 'errors': 0}
+        tick = 0
+
+        async def invoice(n: int):
+            order_id = f"bot_{os.getpid()}_{n}"
+            try:
+                await payments.create(900000 + n, order_id, 100, f"token_{order_id}")
+                await payments.set_invoice(order_id, f"tx_{n}", f"https://pay.platega.io?id=tx_{n}", "2099-01-01 00:00:00")
+                stats['invoices'] += 1
+            except sqlite3.Error:
+                stats['errors'] += 1
+
+        tasks = set()
+        ready.set()
+        started = time.monotonic()
+        while not stop.is_set():
+            tick += 1
+            task = asyncio.create_task(invoice(tick))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if tick % 100 == 0:
+                # Как периодическая запись реестра пользователей
+                profiles = [(800000 + tick + i, f"new{tick + i}", "New") for i in range(50)]
+                task = asyncio.create_task(users.upsert_many(profiles))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.sleep(max(started + tick / rate - time.monotonic(), 0))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await db.close()
+        stats['busy_retries'] = sum(DB_BUSY_RETRIES._values.values())
+        stats['busy_wait_seconds'] = round(sum(DB_BUSY_WAIT._values.values()), 3)
+        stats['locked'] = sum(DB_LOCKED._values.values())
+        results.put(stats)
+
+    asyncio.run(main())
+
+
+class BotProcess:
+    def __init__(self, path: str, rate: float):
+        context = multiprocessing.get_context('spawn')
+        self._ready = context.Event()
+        self._stop = context.Event()
+        self._results = context.Queue()
+        self._process = context.Process(target=bot_writer, args=(path, rate, self._ready, self._stop, self._results), daemon=True)
+        self.enabled = rate > 0
+
+    def __enter__(self):
+        if self.enabled:
+            self._process.start()
+            # Нагрузка начинается, когда бот уже пишет
+            self._ready.wait(timeout=60)
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self._stop.set()
+            self.stats = self._results.get(timeout=60)
+            self._process.join(timeout=10)
+        else:
+            self.stats = {}
+
+
+# ===== HTTP-КЛИЕНТЫ =====
+class AsgiClient:
+    """Приложение в этом процессе, без сети"""
+
+    async def __aenter__(self):
+        try:
+            import httpx
+        except ImportError:
+            sys.exit("Для режима asgi нужен httpx: pip install httpx (или --mode uvicorn)")
+        import web_server
+        self._lifespan = web_server.lifespan(web_server.app)
+        await self._lifespan.__aenter__()
+        self._client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=web_server.app), base_url="http://bench", timeout=60
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._client.aclose()
+        await self._lifespan.__aexit__(None, None, None)
+
+    async def request(self, method: str, path: str, **kwargs) -> tuple:
+        response = await self._client.request(method, path, **kwargs)
+        return response.status_code, response.headers, response.text
+
+
+class HttpClient:
+    """Настоящий HTTP к uvicorn на localhost"""
+
+    def __init__(self, base_url: str, connections: int):
+        self.base_url = base_url
+        self.connections = connections
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def request(self, method: str, path: str, **kwargs) -> tuple:
+        async with self._session.request(method, self.base_url + path, **kwargs) as response:
+            text = await response.text()
+            return response.status, response.headers, text
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_uvicorn(workers: int, env: dict) -> tuple:
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "web_server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        env={**os.environ, **env}
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(200):
+            try:
+                async with session.get(base_url + "/") as response:
+                    if response.status == 200:
+                        return process, base_url
+            except aiohttp.ClientError:
+                pass
+            if process.poll() is not None:
+                sys.exit("uvicorn завершился при запуске")
+            await asyncio.sleep(0.1)
+    process.terminate()
+    sys.exit("uvicorn не ответил за 20 с")
+
+
+# ===== НАГРУЗКА =====
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, client, kind: str, method: str, path: str, ok=(200, 304), **kwargs) -> Optional[tuple]:
+        started = time.perf_counter()
+        try:
+            result = await client.request(method, path, **kwargs)
+        except Exception:
+            result = None
+        self.timings[kind].append(time.perf_counter() - started)
+        if result is None or result[0] not in ok:
+            self.errors[kind] += 1
+        return result
+
+
+def callback_requests(orders: list, duplicate_rate: float) -> list:
+    """Callback CONFIRMED по каждому заказу; часть Platega доставляет повторно"""
+    bodies = []
+    for order_id in orders:
+        body = {"id": f"tx_{order_id}", "amount": 100, "currency": "RUB", "status": "CONFIRMED",
+                "paymentMethod": 2, "payload": order_id}
+        bodies.append(body)
+        if random.random() < duplicate_rate:
+            bodies.append(body)
+    random.shuffle(bodies)
+    return [("callback", "POST", "/platega-callback", {"json": body}) for body in bodies]
+
+
+def vpn_requests(count: int, etags: dict, missing_rate: float = 0.1) -> list:
+    """Обновления страницы VPN: половина клиентов присылает ETag прошлого ответа"""
+    result = []
+    for _ in range(count):
+        if random.random() < missing_rate:
+            result.append(("vpn_missing", "GET", f"/vpn/unknown_{random.randrange(10 ** 6)}", {}))
+            continue
+        token = f"token_{random.randrange(SEEDED_TOKENS)}"
+        headers = {"If-None-Match": etags[token]} if token in etags and random.random() < 0.5 else {}
+        result.append(("vpn", "GET", f"/vpn/{token}", {"headers": headers}))
+    return result
+
+
+def site_requests(count: int, asset_urls: list) -> list:
+    paths = [("page", "/"), ("page", "/privacy"), ("static", "/static/css/style.css")]
+    paths += [("asset", url) for url in asset_urls]
+    return [(kind, "GET", path, {}) for kind, path in (random.choice(paths) for _ in range(count))]
+
+
+async def drive(client, requests: list, concurrency: int, recorder: Recorder, etags: Optional[dict] = None):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(kind, method, path, kwargs):
+        async with semaphore:
+            result = await recorder.call(client, kind, method, path, **kwargs)
+            if etags is not None and kind == "vpn" and result and result[0] == 200:
+                etag = result[1].get("etag")
+                if etag:
+                    etags[path.rsplit("/", 1)[1]] = etag
+
+    await asyncio.gather(*(one(*request) for request in requests))
+
+
+async def contention(client) -> dict:
+    """Счетчики блокировок SQLite веб-сервера из /metrics"""
+    headers = {"Authorization": f"Bearer {os.environ['WEB_METRICS_TOKEN']}"}
+    status, _, text = await client.request("GET", "/metrics", headers=headers)
+    totals = dict.fromkeys(CONTENTION_METRICS, 0.0)
+    for line in text.splitlines():
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in totals:
+            totals[name] += float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def percentiles(timings: list) -> dict:
+    if len(timings) < 2:
+        value = round(timings[0] * 1000, 2) if timings else None
+        return {'p50_ms': value, 'p95_ms': value, 'p99_ms': value}
+    cuts = statistics.quantiles(timings, n=100, method='inclusive')
+    return {'p50_ms': round(cuts[49] * 1000, 2), 'p95_ms': round(cuts[94] * 1000, 2), 'p99_ms': round(cuts[98] * 1000, 2)}
+
+
+async def run_scenario(name: str, client, args, orders: Orders, db_path: str, etags: dict, asset_urls: list) -> dict:
+    if name == 'sale_burst':
+        requests = callback_requests(orders.create(args.requests), args.duplicate_rate)
+    elif name == 'vpn_refresh':
+        requests = vpn_requests(args.requests, etags)
+    elif name == 'site':
+        requests = site_requests(args.requests, asset_urls)
+    else:
+        share = args.requests // 3
+        requests = (
+            callback_requests(orders.create(share), args.duplicate_rate)
+            + vpn_requests(share, etags)
+            + site_requests(share, asset_urls)
+        )
+        random.shuffle(requests)
+
+    recorder = Recorder()
+    before = await contention(client)
+    bot = BotProcess(db_path, args.bot_rate if name in ('sale_burst', 'mixed') else 0)
+    with bot:
+        started = time.perf_counter()
+        await drive(client, requests, args.concurrency, recorder, etags)
+        elapsed = time.perf_counter() - started
+    after = await contention(client)
+
+    total = sum(len(timings) for timings in recorder.timings.values())
+    errors = sum(recorder.errors.values())
+    result = {
+        'requests': total,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(total / elapsed, 1),
+        'error_rate': round(errors / total, 4) if total else 0,
+        **percentiles([t for timings in recorder.timings.values() for t in timings]),
+        'by_kind': {
+            kind: {'requests': len(timings), 'errors': recorder.errors[kind], **percentiles(timings)}
+            for kind, timings in sorted(recorder.timings.items())
+        },
+        'sqlite_server': {
+            'busy_retries': int(after['db_busy_retries_total'] - before['db_busy_retries_total']),
+            'busy_wait_seconds': round(after['db_busy_wait_seconds_total'] - before['db_busy_wait_seconds_total'], 3),
+            'locked': int(after['db_locked_total'] - before['db_locked_total']),
+        },
+        'sqlite_bot': bot.stats,
+    }
+    print(
+        f"{name:<12} {result['requests_per_sec']:>8} req/s | p50 {result['p50_ms']:>7} мс | "
+        f"p95 {result['p95_ms']:>7} мс | p99 {result['p99_ms']:>7} мс | ошибки {result['error_rate']:.2%}"
+    )
+    for kind, stats in result['by_kind'].items():
+        print(f"    {kind:<12} {stats['requests']:>6} | p50 {stats['p50_ms']:>7} мс | p99 {stats['p99_ms']:>7} мс | ошибок {stats['errors']}")
+    server, bot_stats = result['sqlite_server'], result['sqlite_bot']
+    print(f"    SQLite веб: повторов {server['busy_retries']}, ожидание {server['busy_wait_seconds']} с, locked {server['locked']}")
+    if bot_stats:
+        print(f"    SQLite бот: счетов {bot_stats['invoices']}, повторов {bot_stats['busy_retries']}, "
+              f"ожидание {bot_stats['busy_wait_seconds']} с, locked {bot_stats['locked']}, ошибок {bot_stats['errors']}")
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    parser.add_argument("--url", help="уже запущенный сервер (нужен --db с его базой)")
+    parser.add_argument("--db", help="база сервера из --url; в нее добавятся тестовые заказы")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2, help="доля повторных callback")
+    parser.add_argument("--bot-rate", type=float, default=50, help="счетов/с от процесса бота (0 - без него)")
+    parser.add_argument("--output", help="файл результатов (по умолчанию bench_results/web-<время>.json)")
+    args = parser.parse_args()
+
+    # web_server ищет static/ и templates/ относительно текущего каталога
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.url and not args.db:
+        parser.error("с --url нужен --db: тестовые заказы добавляются в базу сервера")
+    workdir = tempfile.mkdtemp(prefix="bench_web_")
+    db_path = args.db or os.path.join(workdir, "bench.db")
+    env = {
+        'DB_PATH': db_path,
+        'OUTBOX_SOCKET': os.path.join(workdir, "outbox.sock"),
+        'LOG_LEVEL': 'WARNING',
+        'WEB_LOG_FILE': '',
+        # Для --url нужен токен запущенного сервера в WEB_METRICS_TOKEN
+        'WEB_METRICS_TOKEN': os.getenv('WEB_METRICS_TOKEN') or secrets.token_hex(16),
+    }
+    os.environ.update(env)
+    if not args.db:
+        seed(db_path)
+
+    server = None
+    if args.mode == "asgi":
+        client = AsgiClient()
+    else:
+        base_url = args.url
+        if base_url is None:
+            server, base_url = await start_uvicorn(args.workers, env)
+        client = HttpClient(base_url.rstrip("/"), args.concurrency)
+
+    print(f"Режим: {args.mode}" + (f", воркеров {args.workers}" if server else "") +
+          f", запросов на сценарий {args.requests}, параллельно {args.concurrency}, бот {args.bot_rate} счетов/с")
+    results = {}
+    try:
+        async with client:
+            _, _, index = await client.request("GET", "/")
+            asset_urls = sorted(set(re.findall(r'/assets/[^"\')\s]+', index)))
+            orders, etags = Orders(db_path), {}
+            for name in (SCENARIOS if args.scenario == "all" else (args.scenario,)):
+                results[name] = await run_scenario(name, client, args, orders, db_path, etags, asset_urls)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+        if not args.db:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'mode': args.mode, 'workers': args.workers if server else None, 'requests': args.requests,
+            'concurrency': args.concurrency, 'duplicate_rate': args.duplicate_rate, 'bot_rate': args.bot_rate,
+        },
+        'scenarios': results,
+    }
+    output = args.output or os.path.join(
+        'bench_results', f"web-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты: {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Рассылка сообщений всем пользователям от имени админа
+
+Получатели читаются из базы пачками по возрастанию users.id, сообщения
+уходят через корзину токенов (глобальный лимит Telegram около 30
+сообщений в секунду). На TelegramRetryAfter вся рассылка ждет указанное
+время и повторяет сообщение. Заблокировавшие бота помечаются is_blocked.
+Раз в секунду прогресс (последний id, до которого все обработано, и
+счетчики) пишется в broadcasts, а сообщение админа обновляется: скорость
+и оставшееся время. После перезапуска рассылка продолжается с
+сохраненного id; повторно могут уйти только сообщения последней секунды
+перед аварийной остановкой (при обычной остановке - ни одного).
+"""
+
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import BroadcastsRepository, UsersRepository
+from metrics import BROADCAST_MESSAGES
+from resilience import retry_delay
+from throttling import TokenBuckets
+
+# Конфигурация
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', '5'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', '500'))
+BROADCAST_RETRIES = int(os.getenv('BROADCAST_RETRIES', '2'))
+BROADCAST_SAVE_INTERVAL = float(os.getenv('BROADCAST_SAVE_INTERVAL', '1'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '3'))
+
+# Окно для расчета текущей скорости, секунды
+RATE_WINDOW = 10
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastJob:
+    """Состояние одной идущей рассылки"""
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.text = row['text']
+        self.admin_chat_id = row['admin_chat_id']
+        self.message_id = row['message_id']
+        self.total = row['total']
+        self.cursor = row['cursor_id']
+        self.sent = row['sent']
+        self.blocked = row['blocked']
+        self.failed = row['failed']
+        # Выданные получатели (users.id) по порядку и уже обработанные из них
+        self.issued: deque = deque()
+        self.done: set = set()
+        self.blocked_ids: list = []
+        self.cancelled = False
+        self.stopping = False
+        self.finished = False
+        # (время, обработано) для расчета скорости
+        self.samples: deque = deque([(time.monotonic(), self.processed)])
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def complete(self, user_row_id: int):
+        """Отмечает получателя обработанным и сдвигает курсор по непрерывному префиксу"""
+        self.done.add(user_row_id)
+        while self.issued and self.issued[0] in self.done:
+            self.cursor = self.issued.popleft()
+            self.done.discard(self.cursor)
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        self.samples.append((now, self.processed))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+        started, processed = self.samples[0]
+        return (self.processed - processed) / (now - started) if now > started else 0.0
+
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        bot: Bot,
+        broadcasts: BroadcastsRepository,
+        users: UsersRepository,
+        registry=None,
+        rate: float = BROADCAST_RATE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        chunk: int = BROADCAST_CHUNK
+    ):
+        self.bot = bot
+        self.broadcasts = broadcasts
+        self.users = users
+        self.registry = registry
+        self.concurrency = concurrency
+        self.chunk = chunk
+        self.buckets = TokenBuckets({'default': (rate, BROADCAST_BURST)})
+        self._turn = asyncio.Lock()
+        # Проверка active и запуск разделены await: без блокировки два подтверждения запустят две рассылки
+        self._launching = asyncio.Lock()
+        self._paused_until = 0.0
+        self.job: Optional[BroadcastJob] = None
+        self._task = None
+        self.stats = {'flood_waits': 0}
+
+    @property
+    def active(self) -> bool:
+        return self.job is not None and not self.job.finished
+
+    async def start(self):
+        """Продолжает рассылку, прерванную остановкой бота"""
+        async with self._launching:
+            for row in await self.broadcasts.get_running():
+                if self.active:
+                    logger.warning(f"⚠️ Рассылка #{row['id']} ждет завершения #{self.job.id}")
+                    break
+                logger.info(f"📣 Продолжаем рассылку #{row['id']} с пользователя id>{row['cursor_id']}")
+                self._spawn(BroadcastJob(row))
+
+    async def stop(self):
+        """Дожидается отправляемых сообщений и сохраняет прогресс (рассылка продолжится после запуска)"""
+        if self._task is not None:
+            self.job.stopping = True
+            await self._task
+            self._task = None
+
+    async def launch(self, broadcast_id: int, message_id: int) -> bool:
+        """Запускает черновик рассылки; message_id - сообщение админа для прогресса"""
+        async with self._launching:
+            if self.active:
+                return False
+            total = await self.users.count_recipients()
+            if not await self.broadcasts.start(broadcast_id, message_id, total):
+                return False
+            self._spawn(BroadcastJob(await self.broadcasts.get(broadcast_id)))
+        logger.info(f"📣 Рассылка #{broadcast_id} запущена: {total} получателей")
+        return True
+
+    def cancel(self, broadcast_id: int) -> bool:
+        if not self.active or self.job.id != broadcast_id:
+            return False
+        self.job.cancelled = True
+        return True
+
+    def _spawn(self, job: BroadcastJob):
+        self.job = job
+        self._task = asyncio.create_task(self._run(job))
+
+    # ===== ОТПРАВКА =====
+    async def _wait_turn(self):
+        """Очередь на отправку: пауза после RetryAfter и корзина токенов"""
+        async with self._turn:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                wait = self.buckets.take(0, 'broadcast')
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+    async def _run(self, job: BroadcastJob):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: set = set()
+        reporter = asyncio.create_task(self._report(job))
+        after = job.cursor
+        try:
+            while not (job.cancelled or job.stopping):
+                recipients = await self.users.get_recipients(after, self.chunk)
+                if not recipients:
+                    break
+                for row in recipients:
+                    await semaphore.acquire()
+                    if job.cancelled or job.stopping:
+                        semaphore.release()
+                        break
+                    after = row['id']
+                    job.issued.append(row['id'])
+                    task = asyncio.create_task(self._deliver(job, row['id'], row['telegram_id'], semaphore))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except Exception as e:
+            logger.error(f"❌ Рассылка #{job.id} прервана: {e}")
+            job.stopping = True
+        finally:
+            job.finished = True
+            reporter.cancel()
+            try:
+                await reporter
+            except asyncio.CancelledError:
+                pass
+            if job.cancelled:
+                status = 'cancelled'
+            elif job.stopping:
+                status = 'running'
+            else:
+                status = 'done'
+            await self._save(job, status)
+            await self._show(job, status)
+            logger.info(
+                f"📣 Рассылка #{job.id}: {status}, отправлено {job.sent}, "
+                f"заблокировали {job.blocked}, ошибок {job.failed}"
+            )
+
+    async def _deliver(self, job: BroadcastJob, user_row_id: int, chat_id: int, semaphore: asyncio.Semaphore):
+        attempt = 0
+        try:
+            while True:
+                await self._wait_turn()
+                try:
+                    await self.bot.send_message(chat_id, job.text)
+                    job.sent += 1
+                    BROADCAST_MESSAGES.inc('sent')
+                    return
+                except TelegramRetryAfter as e:
+                    # Лимит превышен: ждут все отправки, сообщение повторяется
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    self.stats['flood_waits'] += 1
+                    BROADCAST_MESSAGES.inc('flood_wait')
+                    logger.warning(f"⏸ Рассылка #{job.id}: flood wait {e.retry_after} с")
+                except TelegramForbiddenError:
+                    # Бот заблокирован или аккаунт удален
+                    job.blocked += 1
+                    job.blocked_ids.append(chat_id)
+                    if self.registry is not None:
+                        self.registry.forget(chat_id)
+                    BROADCAST_MESSAGES.inc('blocked')
+                    return
+                except TelegramBadRequest as e:
+                    job.failed += 1
+                    BROADCAST_MESSAGES.inc('failed')
+                    logger.info(f"Рассылка #{job.id}: {chat_id} пропущен: {e.message}")
+                    return
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    if attempt >= BROADCAST_RETRIES:
+                        job.failed += 1
+                        BROADCAST_MESSAGES.inc('failed')
+                        logger.warning(f"⚠️ Рассылка #{job.id}: {chat_id} не доставлено: {e}")
+                        return
+                    await asyncio.sleep(retry_delay(attempt))
+                    attempt += 1
+        finally:
+            job.complete(user_row_id)
+            semaphore.release()
+
+    # ===== ПРОГРЕСС =====
+    async def _save(self, job: BroadcastJob, status: str = 'running'):
+        blocked_ids, job.blocked_ids = job.blocked_ids, []
+        try:
+            await self.broadcasts.save_progress(
+                job.id, job.cursor, job.sent, job.blocked, job.failed, blocked_ids, status
+            )
+        except Exception:
+            job.blocked_ids = blocked_ids + job.blocked_ids
+            raise
+
+    async def _report(self, job: BroadcastJob):
+        last_shown = 0.0
+        while True:
+            await asyncio.sleep(BROADCAST_SAVE_INTERVAL)
+            try:
+                await self._save(job)
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить прогресс рассылки #{job.id}: {e}")
+            if time.monotonic() - last_shown >= BROADCAST_PROGRESS_INTERVAL:
+                last_shown = time.monotonic()
+                await self._show(job, 'running')
+
+    def progress_text(self, job: BroadcastJob, status: str) -> str:
+        if status == 'running':
+            pause = self._paused_until - time.monotonic()
+            title = f"пауза {pause:.0f} с (лимит Telegram)" if pause > 0 else "идет"
+        else:
+            title = {'done': "завершена ✅", 'cancelled': "остановлена ⏹"}.get(status, "прервана, продолжится после перезапуска")
+        lines = [
+            f"📣 <b>Рассылка #{job.id}</b>: {title}",
+            "",
+            f"Обработано: <b>{job.processed}</b> из {job.total}",
+            f"• доставлено: {job.sent}",
+            f"• заблокировали бота: {job.blocked}",
+            f"• ошибок: {job.failed}",
+        ]
+        if status == 'running':
+            rate = job.rate()
+            remaining = max(job.total - job.processed, 0)
+            eta = format_eta(remaining / rate) if rate > 0 else "—"
+            lines.append(f"\nСкорость: {rate:.1f} сообщ./с, осталось ~{eta}")
+        return "\n".join(lines)
+
+    async def _show(self, job: BroadcastJob, status: str):
+        """Обновляет сообщение админа с прогрессом"""
+        if not job.message_id:
+            return
+        keyboard = None
+        if status == 'running' and not job.finished:
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bc_stop_{job.id}")]
+            ])
+        try:
+            await self._wait_turn()
+            await self.bot.edit_message_text(
+                self.progress_text(job, status),
+                chat_id=job.admin_chat_id,
+                message_id=job.message_id,
+                reply_markup=keyboard
+            )
+        except TelegramRetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+        except Exception as e:
+            # "message is not modified" и т.п.: прогресс покажем в следующий раз
+            logger.debug(f"Прогресс рассылки #{job.id} не обновлен: {e}")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Групповая запись callback Platega в базу
+
+Во время наплыва оплат каждый callback отдельной транзакцией платит за
+свой fsync, а параллельные писатели упираются в блокировку SQLite.
+Здесь callback попадают в ограниченную очередь, а одна задача-писатель
+применяет их пачками в одной транзакции: пачка закрывается по размеру
+или по таймеру. Ответ Platega уходит только после коммита пачки, в
+которой записан callback, поэтому подтвержденный callback не теряется.
+"""
+
+import os
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from database import Database, transition_payment
+
+# Конфигурация
+CALLBACK_BATCH = int(os.getenv('CALLBACK_BATCH', '100'))
+CALLBACK_FLUSH_INTERVAL = float(os.getenv('CALLBACK_FLUSH_INTERVAL', '0.005'))
+CALLBACK_QUEUE_SIZE = int(os.getenv('CALLBACK_QUEUE_SIZE', '2000'))
+
+logger = logging.getLogger(__name__)
+
+
+class WriterOverloaded(Exception):
+    """Очередь записи переполнена: callback нужно отклонить (Platega повторит)"""
+
+
+class CallbackWriter:
+    def __init__(
+        self,
+        db: Database,
+        batch_size: int = CALLBACK_BATCH,
+        flush_interval: float = CALLBACK_FLUSH_INTERVAL,
+        max_queue: int = CALLBACK_QUEUE_SIZE
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task = None
+        self.stats = {'batches': 0, 'written': 0, 'rejected': 0, 'max_batch': 0}
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._loop())
+            logger.info("🗂 Групповая запись callback запущена")
+
+    async def stop(self):
+        """Дописывает уже принятые callback и останавливает писателя"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, order_id: str, status: str, platega_id: Optional[str] = None) -> tuple:
+        """Ставит переход статуса в очередь и ждет коммита; результат как у transition_payment"""
+        if self._task is None:
+            raise RuntimeError("CallbackWriter не запущен")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((future, (order_id, status, platega_id)))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise WriterOverloaded(f"очередь записи заполнена ({self.max_queue})")
+        return await future
+
+    async def _collect(self, first) -> tuple:
+        """Добирает пачку до batch_size или до истечения flush_interval"""
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    @staticmethod
+    def _apply(conn, items: list) -> list:
+        return [transition_payment(conn, *args) for args in items]
+
+    async def _loop(self):
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch, stopping = await self._collect(first)
+            futures = [future for future, _ in batch]
+            try:
+                results = await self.db.run(self._apply, [args for _, args in batch])
+            except Exception as e:
+                # Вся пачка откатилась: каждый callback получит ошибку, Platega повторит
+                logger.error(f"❌ Ошибка записи пачки из {len(batch)} callback: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+            self.stats['batches'] += 1
+            self.stats['written'] += len(batch)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Асинхронный слой доступа к базе данных (общий для бота и веб-сервера)
+
+Запросы выполняются в отдельном пуле потоков на ограниченном наборе
+переиспользуемых соединений SQLite, поэтому медленный запрос или
+заблокированная база не останавливают event loop.
+"""
+
+import os
+import asyncio
+import logging
+import queue
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+
+from migrations import migrate, recount_counters, rebuild_counters
+from outbox import enqueue, PAYMENT_CONFIRMED
+import profiler
+from metrics import DB_BUSY_RETRIES, DB_BUSY_WAIT, DB_LATENCY, DB_LOCKED, add_collector, gauge_lines, statement_class
+
+load_dotenv()
+
+# Конфигурация
+DB_PATH = os.getenv('DB_PATH', 'vpn.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))
+VPN_DURATION = int(os.getenv('VPN_DURATION', '30'))
+# Пауза между повторами при занятой базе: от 1 мс с удвоением до 50 мс
+DB_BUSY_RETRY_MIN = 0.001
+DB_BUSY_RETRY_MAX = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+def connect(path: str = DB_PATH, timeout: float = DB_BUSY_TIMEOUT) -> sqlite3.Connection:
+    """Открывает соединение с настройками, общими для всех процессов"""
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL позволяет читать параллельно с записью из другого процесса
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class DatabaseLocked(sqlite3.OperationalError):
+    """База оставалась занятой другим писателем дольше DB_BUSY_TIMEOUT"""
+
+    def __init__(self, message: str, retries: int, waited: float):
+        super().__init__(message)
+        self.retries = retries
+        self.waited = waited
+
+
+def is_busy_error(error: sqlite3.OperationalError) -> bool:
+    """SQLITE_BUSY / SQLITE_LOCKED: "database is locked", "database table is locked" и т.п."""
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def init_database(path: str = DB_PATH):
+    """Инициализация базы данных: применяет недостающие миграции схемы"""
+    version = migrate(path)
+    logger.info(f"✅ База данных инициализирована (версия схемы {version})")
+
+
+def enqueue_payment_confirmed(conn: sqlite3.Connection, order_id: str, telegram_id: int, vpn_token: str):
+    """Событие для бота: отправить пользователю ссылку на VPN"""
+    enqueue(conn, PAYMENT_CONFIRMED, {
+        'order_id': order_id,
+        'telegram_id': telegram_id,
+        'vpn_token': vpn_token,
+    })
+
+
+def transition_payment(conn: sqlite3.Connection, order_id: str, status: str, platega_id: Optional[str] = None) -> tuple:
+    """Переводит платеж из pending в финальный статус одним условным UPDATE.
+
+    Возвращает (результат, платеж): 'applied' и (telegram_id, vpn_token), если
+    статус записан; 'ignored', если платеж уже в финальном статусе;
+    'not_found', если платежа нет. Финальный статус никогда не перезаписывается,
+    поэтому поздний CANCELED не отменит успешную оплату. Успешная оплата в той же
+    транзакции ставит событие в outbox для бота.
+    """
+    payment = conn.execute('''
+        UPDATE payments
+        SET status = ?, completed_at = CURRENT_TIMESTAMP,
+            platega_order_id = COALESCE(?, platega_order_id)
+        WHERE order_id = ? AND status = 'pending'
+        RETURNING telegram_id, vpn_token
+    ''', (status, platega_id, order_id)).fetchone()
+    if payment:
+        if status == 'success':
+            enqueue_payment_confirmed(conn, order_id, payment['telegram_id'], payment['vpn_token'])
+        return 'applied', payment
+    # Второй запрос нужен только для повторов, не отсеянных кэшем
+    exists = conn.execute("SELECT 1 FROM payments WHERE order_id = ?", (order_id,)).fetchone()
+    return ('ignored' if exists else 'not_found'), None
+
+
+class Database:
+    """Ограниченный пул соединений SQLite, обслуживаемый отдельными потоками"""
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = DB_POOL_SIZE, busy_timeout: float = DB_BUSY_TIMEOUT):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._connections: list = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.pool_size,
+                thread_name_prefix="db"
+            )
+        return self._executor
+
+    def _run(self, fn: Callable, args: tuple) -> tuple:
+        """Выполняет транзакцию; возвращает (результат, повторов из-за блокировки, секунд ожидания)"""
+        # Потоков не больше pool_size, поэтому и соединений не больше pool_size
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            # Переключение в WAL при открытии ждет блокировку средствами SQLite, а дальше -
+            # без встроенного ожидания: повторы ниже, чтобы их можно было посчитать
+            conn = connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA busy_timeout = 0")
+            self._connections.append(conn)
+        retries, waited, delay = 0, 0.0, DB_BUSY_RETRY_MIN
+        try:
+            while True:
+                try:
+                    with conn:
+                        return fn(conn, *args), retries, waited
+                except sqlite3.OperationalError as e:
+                    if not is_busy_error(e):
+                        raise
+                    # Блокировка могла случиться на COMMIT, тогда транзакция еще открыта
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if waited >= self.busy_timeout:
+                        raise DatabaseLocked(f"{e} (ждали {waited:.2f} с, повторов {retries})", retries, waited) from e
+                    time.sleep(delay)
+                    retries += 1
+                    waited += delay
+                    delay = min(delay * 2, DB_BUSY_RETRY_MAX)
+        finally:
+            self._pool.put(conn)
+
+    async def run(self, fn: Callable, *args, label: Optional[str] = None) -> Any:
+        """Выполняет fn(conn, *args) в пуле в рамках одной транзакции.
+
+        Если база занята другим писателем, транзакция откатывается и fn
+        выполняется заново (до DB_BUSY_TIMEOUT), поэтому fn должна только
+        работать с conn.
+        """
+        loop = asyncio.get_running_loop()
+        # Метка: класс SQL-запроса или имя функции (без <locals>.<lambda>)
+        label = label or fn.__qualname__.split('.<locals>')[0]
+        started = time.perf_counter()
+        retries, waited = 0, 0.0
+        try:
+            result, retries, waited = await loop.run_in_executor(self._get_executor(), self._run, fn, args)
+            return result
+        except DatabaseLocked as e:
+            retries, waited = e.retries, e.waited
+            DB_LOCKED.inc(label)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, label)
+            if retries:
+                DB_BUSY_RETRIES.inc(label, amount=retries)
+                DB_BUSY_WAIT.inc(label, amount=waited)
+            profiler.record('db', label, started)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), label=statement_class(sql))
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), label=statement_class(sql))
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Выполняет запрос на изменение и возвращает число затронутых строк"""
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount, label=statement_class(sql))
+
+    async def close(self):
+        """Останавливает пул потоков и закрывает все соединения"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        self._pool = queue.LifoQueue()
+
+
+# ===== РЕПОЗИТОРИИ =====
+class UsersRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def upsert_many(self, profiles: list):
+        """Сохраняет пользователей [(telegram_id, username, first_name)]: новых добавляет, у известных обновляет профиль.
+
+        Пользователь снова пишет боту - значит, больше не блокирует его: отметка is_blocked снимается.
+        """
+        await self.db.run(lambda conn: conn.executemany('''
+            INSERT INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE
+            SET username = excluded.username, first_name = excluded.first_name, is_blocked = 0
+            WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name OR is_blocked = 1
+        ''', profiles))
+
+    async def get_profiles(self, limit: int) -> list:
+        """Профили последних limit пользователей (для прогрева кэша).
+
+        Заблокировавшие бота не попадают в реестр: их следующий /start должен дойти
+        до базы и снять is_blocked, в том числе после перезапуска.
+        """
+        return await self.db.fetchall(
+            "SELECT telegram_id, username, first_name FROM users WHERE is_blocked = 0 ORDER BY id DESC LIMIT ?",
+            (limit,)
+        )
+
+    async def get_page(self, limit: int, before_id: Optional[int] = None, after_id: Optional[int] = None) -> list:
+        """Страница пользователей (новые сначала) по ключу id вместо OFFSET.
+
+        before_id - следующая страница (id меньше), after_id - предыдущая (id больше).
+        """
+        columns = "id, telegram_id, username, first_name, is_active, created_at"
+        if after_id is not None:
+            rows = await self.db.fetchall(
+                f"SELECT {columns} FROM users WHERE id > ? ORDER BY id ASC LIMIT ?",
+                (after_id, limit)
+            )
+            return rows[::-1]
+        if before_id is not None:
+            return await self.db.fetchall(
+                f"SELECT {columns} FROM users WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit)
+            )
+        return await self.db.fetchall(f"SELECT {columns} FROM users ORDER BY id DESC LIMIT ?", (limit,))
+
+    async def get_last_page(self, limit: int) -> list:
+        """Последняя страница: самые старые пользователи"""
+        rows = await self.db.fetchall(
+            "SELECT id, telegram_id, username, first_name, is_active, created_at FROM users ORDER BY id ASC LIMIT ?",
+            (limit,)
+        )
+        return rows[::-1]
+
+    async def get_recipients(self, after_id: int, limit: int) -> list:
+        """Следующая пачка получателей рассылки по возрастанию id (без заблокировавших бота)"""
+        return await self.db.fetchall(
+            "SELECT id, telegram_id FROM users WHERE id > ? AND is_blocked = 0 ORDER BY id LIMIT ?",
+            (after_id, limit)
+        )
+
+    async def get_subscription(self, telegram_id: int) -> Optional[sqlite3.Row]:
+        return await self.db.fetchone(
+            "SELECT is_active, expires_at FROM users WHERE telegram_id = ?",
+            (telegram_id,)
+        )
+
+    async def next_expiries(self, limit: int) -> list:
+        """Ближайшие сроки активных подписок; INDEXED BY - чтение только начала индекса, без обхода таблицы.
+
+        is_active = 1 без срока бывает у пользователей до миграции 9 без успешных оплат:
+        NULL в индексе идет первым, поэтому такие строки отсекаются явно.
+        """
+        return await self.db.fetchall(
+            "SELECT telegram_id, expires_at, reminded FROM users INDEXED BY idx_users_expiry "
+            "WHERE is_active = 1 AND expires_at IS NOT NULL ORDER BY expires_at LIMIT ?",
+            (limit,)
+        )
+
+    async def deactivate_expired(self, now: str, limit: int) -> list:
+        """Выключает пачку истекших подписок; возвращает их telegram_id"""
+        return await self.db.run(lambda conn: conn.execute('''
+            UPDATE users SET is_active = 0
+            WHERE id IN (
+                SELECT id FROM users INDEXED BY idx_users_expiry
+                WHERE is_active = 1 AND expires_at IS NOT NULL AND expires_at <= ? ORDER BY expires_at LIMIT ?
+            )
+            RETURNING telegram_id, expires_at
+        ''', (now, limit)).fetchall(), label="UPDATE users expired")
+
+    async def claim_reminders(self, until: str, limit: int) -> list:
+        """Отмечает напомненными пачку подписок, истекающих до until; возвращает их (telegram_id, expires_at)"""
+        return await self.db.run(lambda conn: conn.execute('''
+            UPDATE users SET reminded = 1
+            WHERE id IN (
+                SELECT id FROM users INDEXED BY idx_users_renewal
+                WHERE is_active = 1 AND reminded = 0 AND expires_at IS NOT NULL AND expires_at <= ? ORDER BY expires_at LIMIT ?
+            )
+            RETURNING telegram_id, expires_at
+        ''', (until, limit)).fetchall(), label="UPDATE users reminded")
+
+    async def count_recipients(self, after_id: int = 0) -> int:
+        row = await self.db.fetchone("SELECT COUNT(*) FROM users WHERE id > ? AND is_blocked = 0", (after_id,))
+        return row[0]
+
+
+class PaymentsRepository:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def create(self, telegram_id: int, order_id: str, amount: int, vpn_token: str,
+                     duration_days: int = VPN_DURATION):
+        await self.db.execute(
+            "INSERT INTO payments (telegram_id, order_id, amount, vpn_token, duration_days) VALUES (?, ?, ?, ?, ?)",
+            (telegram_id, order_id, amount, vpn_token, duration_days)
+        )
+
+    async def get_status(self, order_id: str) -> Optional[sqlite3.Row]:
+        return await self.db.fetchone(
+            "SELECT status, vpn_token FROM payments WHERE order_id = ?",
+            (order_id,)
+        )
+
+    async def set_invoice(self, order_id: str, transaction_id: Optional[str], payment_url: str, expires_at: str):
+        """Сохраняет ID транзакции Platega (для сверки статуса), ссылку на оплату и срок ее действия"""
+        await self.db.execute(
+            "UPDATE payments SET platega_order_id = ?, payment_url = ?, expires_at = ? WHERE order_id = ?",
+            (transaction_id, payment_url, expires_at, order_id)
+        )
+
+    async def get_open_invoice(self, telegram_id: int, amount: int, valid_until: str) -> Optional[sqlite3.Row]:
+        """Последний неоплаченный счет пользователя на эту сумму, действующий после valid_until"""
+        return await self.db.fetchone('''
+            SELECT order_id, payment_url, expires_at FROM payments
+            WHERE telegram_id = ? AND status = 'pending' AND amount = ?
+                AND payment_url IS NOT NULL AND expires_at > ?
+            ORDER BY id DESC LIMIT 1
+        ''', (telegram_id, amount, valid_until))
+
+    async def transition(self, order_id: str, status: str, platega_id: Optional[str] = None) -> tuple:
+        """Переводит платеж из pending в финальный статус (см. transition_payment)"""
+        return await self.db.run(transition_payment, order_id, status, platega_id)
+
+    async def get_user_stats(self, telegram_id: int) -> Optional[sqlite3.Row]:
+        return await self.db.fetchone(
+            "SELECT COUNT(*) as total_payments, SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END) as successful_payments FROM payments WHERE telegram_id = ?",
+            (telegram_id,)
+        )
+
+    async def get_success_by_token(self, token: str) -> Optional[sqlite3.Row]:
+        """Оплаченный платеж по токену VPN, если подписка пользователя еще действует"""
+        return await self.db.fetchone('''
+            SELECT p.*, u.username, u.first_name, u.expires_at AS subscription_expires_at
+            FROM payments p
+            JOIN users u ON p.telegram_id = u.telegram_id
+            WHERE p.vpn_token = ? AND p.status = 'success'
+                AND u.is_active = 1 AND u.expires_at > datetime('now')
+        ''', (token,))
+
+
+class StatsRepository:
+    """Агрегаты для админки из таблицы counters (поддерживается триггерами)"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self) -> dict:
+        rows = await self.db.fetchall("SELECT name, value FROM counters")
+        stats = dict.fromkeys(
+            ('users_total', 'users_active', 'payments_total', 'payments_success',
+             'payments_pending', 'payments_failed', 'revenue'),
+            0
+        )
+        stats.update((row['name'], row['value']) for row in rows)
+        return stats
+
+    async def verify(self) -> dict:
+        """Сравнивает счетчики с полным пересчетом; возвращает {имя: (счетчик, пересчет)} для расхождений"""
+        def query(conn):
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            actual = recount_counters(conn)
+            return {
+                name: (counters.get(name, 0), actual.get(name, 0))
+                for name in counters.keys() | actual.keys()
+                if counters.get(name, 0) != actual.get(name, 0)
+            }
+        return await self.db.run(query)
+
+    async def rebuild(self) -> dict:
+        """Пересчитывает счетчики с нуля"""
+        return await self.db.run(rebuild_counters)
+
+
+class BroadcastsRepository:
+    """Рассылки админа и их прогресс"""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def create(self, text: str, admin_chat_id: int) -> int:
+        return await self.db.run(lambda conn: conn.execute(
+            "INSERT INTO broadcasts (text, admin_chat_id) VALUES (?, ?)", (text, admin_chat_id)
+        ).lastrowid)
+
+    async def get(self, broadcast_id: int) -> Optional[sqlite3.Row]:
+        return await self.db.fetchone("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+    async def get_running(self) -> list:
+        return await self.db.fetchall("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+
+    async def start(self, broadcast_id: int, message_id: int, total: int) -> bool:
+        """draft -> running; False, если рассылку уже запустили или отменили"""
+        return await self.db.execute('''
+            UPDATE broadcasts SET status = 'running', message_id = ?, total = ?, started_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'draft'
+        ''', (message_id, total, broadcast_id)) == 1
+
+    async def save_progress(self, broadcast_id: int, cursor_id: int, sent: int, blocked: int, failed: int,
+                            blocked_ids: list, status: str = 'running'):
+        """Прогресс и отметки заблокировавших бота - одной транзакцией"""
+        def save(conn):
+            if blocked_ids:
+                conn.executemany("UPDATE users SET is_blocked = 1 WHERE telegram_id = ?", [(i,) for i in blocked_ids])
+            conn.execute('''
+                UPDATE broadcasts SET cursor_id = ?, sent = ?, blocked = ?, failed = ?, status = ?,
+                    finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = ?
+            ''', (cursor_id, sent, blocked, failed, status, status, broadcast_id))
+        await self.db.run(save)
+
+    async def cancel_draft(self, broadcast_id: int) -> bool:
+        return await self.db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'draft'",
+            (broadcast_id,)
+        ) == 1
+
+
+db = Database()
+users_repo = UsersRepository(db)
+payments_repo = PaymentsRepository(db)
+stats_repo = StatsRepository(db)
+broadcasts_repo = BroadcastsRepository(db)
+
+
+async def collect_counters() -> list:
+    """Метрики из таблицы counters: пользователи, платежи по статусам, выручка"""
+    stats = await stats_repo.get()
+    return gauge_lines('vpn_counter', 'Агрегаты из таблицы counters', {(name,): value for name, value in stats.items()}, ('name',))
+
+
+add_collector(collect_counters)
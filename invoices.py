@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Переиспользование действующих счетов Platega
+
+Счет Platega действует expiresIn (~30 мин). Повторное нажатие "Купить"
+в это время возвращает уже выданную ссылку вместо нового платежа и
+~3 с ожидания Platega. Счета кэшируются по (пользователь, сумма) на срок
+их действия, после перезапуска бота берутся из payments, а одновременные
+нажатия одного пользователя ждут одно и то же создание счета.
+"""
+
+import os
+import asyncio
+import logging
+import time
+import uuid
+from typing import NamedTuple, Optional
+
+from cache import TTLCache
+from database import PaymentsRepository
+from logging_setup import bind_log_context
+from resilience import CircuitOpenError
+from platega import PlategaAPI, parse_expires_in
+from timeutil import format_timestamp, parse_timestamp
+
+# Конфигурация
+INVOICE_CACHE_SIZE = int(os.getenv('INVOICE_CACHE_SIZE', '10000'))
+# Срок действия счета, если Platega не вернула expiresIn
+INVOICE_DEFAULT_TTL = int(os.getenv('INVOICE_DEFAULT_TTL', '1500'))
+# Не выдаем счет, который истечет раньше, чем пользователь успеет оплатить
+INVOICE_REUSE_MARGIN = int(os.getenv('INVOICE_REUSE_MARGIN', '120'))
+# Одновременных запросов создания счета к Platega (на весь бот)
+INVOICE_CONCURRENCY = int(os.getenv('INVOICE_CONCURRENCY', '10'))
+
+logger = logging.getLogger(__name__)
+
+
+class Invoice(NamedTuple):
+    order_id: str
+    payment_url: str
+    expires_at: float  # unix time
+    reused: bool = False
+
+
+class InvoiceService:
+    def __init__(
+        self,
+        payments: PaymentsRepository,
+        platega: PlategaAPI,
+        cache_size: int = INVOICE_CACHE_SIZE,
+        margin: int = INVOICE_REUSE_MARGIN,
+        concurrency: int = INVOICE_CONCURRENCY
+    ):
+        self.payments = payments
+        self.platega = platega
+        self.margin = margin
+        self.cache = TTLCache(maxsize=cache_size, ttl=INVOICE_DEFAULT_TTL)
+        self._inflight: dict = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {'created': 0, 'cached': 0, 'restored': 0, 'coalesced': 0, 'failed': 0}
+
+    async def get_or_create(self, telegram_id: int, amount: int, description: str) -> Optional[Invoice]:
+        """Действующий счет пользователя на сумму amount или новый; None, если Platega не создала счет"""
+        key = (telegram_id, amount)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._obtain(key, description))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _obtain(self, key: tuple, description: str) -> Optional[Invoice]:
+        telegram_id, amount = key
+        invoice = self.cache.get(key)
+        if invoice is not None:
+            # Счет мог быть оплачен или отменен через callback в веб-сервере
+            payment = await self.payments.get_status(invoice.order_id)
+            if payment and payment['status'] == 'pending':
+                self.stats['cached'] += 1
+                return invoice._replace(reused=True)
+            self.cache.pop(key)
+
+        row = await self.payments.get_open_invoice(
+            telegram_id, amount, format_timestamp(time.time() + self.margin)
+        )
+        if row:
+            invoice = Invoice(row['order_id'], row['payment_url'], parse_timestamp(row['expires_at']), reused=True)
+            self._remember(key, invoice)
+            self.stats['restored'] += 1
+            return invoice
+
+        return await self._create(key, description)
+
+    async def _create(self, key: tuple, description: str) -> Optional[Invoice]:
+        telegram_id, amount = key
+        # Platega недоступна: отказываем до записи платежа в базу
+        self.platega.breaker.ensure_available()
+        # Миллисекунды: новый счет сразу после оплаты не совпадет по order_id с предыдущим
+        order_id = f"vpn_{telegram_id}_{int(time.time() * 1000)}"
+        bind_log_context(order_id=order_id)
+        await self.payments.create(telegram_id, order_id, amount, str(uuid.uuid4()))
+
+        async with self._semaphore:
+            try:
+                result = await self.platega.create_payment(amount=amount, order_id=order_id, description=description)
+            except CircuitOpenError:
+                # Автомат разомкнулся (или пробный вызов уже занят), пока ждали семафор: запрос
+                # в Platega не уходил, поэтому платеж можно сразу закрыть, а не оставлять в pending
+                self.stats['failed'] += 1
+                await self.payments.transition(order_id, 'failed')
+                raise
+        if not result:
+            self.stats['failed'] += 1
+            return None
+
+        expires_in = parse_expires_in(result.get('expiresIn')) or INVOICE_DEFAULT_TTL
+        invoice = Invoice(order_id, result['redirect'], time.time() + expires_in)
+        await self.payments.set_invoice(
+            order_id, result.get('transactionId'), invoice.payment_url, format_timestamp(invoice.expires_at)
+        )
+        self._remember(key, invoice)
+        self.stats['created'] += 1
+        return invoice
+
+    def _remember(self, key: tuple, invoice: Invoice):
+        ttl = invoice.expires_at - time.time() - self.margin
+        if ttl > 0:
+            self.cache.set(key, invoice._replace(reused=False), ttl=ttl)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Настройка логирования для бота и веб-сервера
+
+Записи уходят в очередь, а в файл и консоль их пишет отдельный поток
+(QueueListener), поэтому медленный диск не останавливает event loop.
+Файл ротируется по размеру и возрасту, старые части сжимаются gzip.
+Формат - текст или JSON lines (LOG_FORMAT=json); поля корреляции
+(update_id, user_id, order_id, request_id) добавляются из контекста.
+Шумные логгеры можно прореживать: LOG_SAMPLING="platega.payload=0.1".
+"""
+
+import os
+import atexit
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# Конфигурация
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_MAX_AGE = float(os.getenv('LOG_MAX_AGE', str(24 * 3600)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '7'))
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'platega.payload=0.1,aiogram.event=0.1')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'
+
+_context: contextvars.ContextVar = contextvars.ContextVar('log_context', default={})
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Добавляет поля корреляции ко всем записям внутри блока (и в порожденных задачах)"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Добавляет поля корреляции до конца текущей задачи (у каждого запроса и апдейта она своя)"""
+    _context.set({**_context.get(), **fields})
+
+
+def parse_sampling(value: str) -> dict:
+    """"logger=0.1,other=0.5" -> {'logger': 0.1, 'other': 0.5}"""
+    rates = {}
+    for part in value.split(','):
+        name, _, rate = part.strip().partition('=')
+        if name and rate:
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Прореживает шумные логгеры и сохраняет контекст до передачи записи в другой поток"""
+
+    def __init__(self, sampling: dict):
+        super().__init__()
+        self.sampling = sampling
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            rate = self.sampling.get(record.name)
+            if rate is not None and random.random() >= rate:
+                return False
+        record.ctx = _context.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        ctx = getattr(record, 'ctx', None)
+        record.context = (' [' + ' '.join(f'{k}={v}' for k, v in ctx.items()) + ']') if ctx else ''
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'ctx', None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не склеивает traceback с сообщением: он остается в exc_text для форматтера"""
+
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация по размеру или возрасту файла; ротированные части сжимаются gzip"""
+
+    def __init__(self, filename: str, max_bytes: int, max_age: float, backups: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self.max_age = max_age
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+        self._opened_at = time.time()
+
+    @staticmethod
+    def _compress(source: str, dest: str):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.max_age and time.time() - self._opened_at >= self.max_age:
+            return os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._opened_at = time.time()
+
+
+def setup_logging(log_file: Optional[str] = None, level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Настраивает корневой логгер один раз на процесс (повторные вызовы игнорируются)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if fmt == 'json' else TextFormatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(CompressingRotatingFileHandler(log_file, LOG_MAX_BYTES, LOG_MAX_AGE, LOG_BACKUPS))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(parse_sampling(LOG_SAMPLING)))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
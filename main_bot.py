@@ -7,21 +7,32 @@ VPN Telegram Bot с оплатой через Platega (СБП QR)
 import os
 import asyncio
 import logging
-import sqlite3
-import uuid
-import json
-from datetime import datetime
-from typing import Optional
+import time
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from fastapi import Request, Response
 
-import aiohttp
 from dotenv import load_dotenv
 
+from database import init_database, db, users_repo, payments_repo, stats_repo, broadcasts_repo
+from platega import PlategaAPI
+from reconciler import PaymentReconciler
+from invoices import InvoiceService
+from resilience import CircuitOpenError
+from throttling import ThrottlingMiddleware
+from user_registry import UserRegistry
+from broadcast import Broadcaster
+from subscriptions import SubscriptionScheduler, REMIND
+from logging_setup import setup_logging, log_context
+from profiler import profiler, PROFILE_UPDATES
+from metrics import HANDLER_LATENCY, BOT_METRICS_PORT, add_collector, gauge_lines, start_metrics_server
+from outbox import OutboxConsumer, PAYMENT_CONFIRMED
+from timeutil import parse_timestamp
+
 # ===== ЗАГРУЗКА КОНФИГУРАЦИИ =====
 load_dotenv()
 
@@ -33,6 +44,11 @@ PLATEGA_API_KEY = os.getenv('PLATEGA_API_KEY', '')
 PLATEGA_MERCHANT_ID = os.getenv('PLATEGA_MERCHANT_ID', '')
 WEB_URL = os.getenv('WEB_URL', 'https://secureprodaww.ru')
 VPN_DURATION = int(os.getenv('VPN_DURATION', '30'))
+# Режим получения обновлений: polling (по умолчанию) или webhook через FastAPI app из web_server.py
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram-webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+BOT_LOG_FILE = os.getenv('BOT_LOG_FILE', 'bot.log')
 
 # Проверка обязательных полей
 if not BOT_TOKEN:
@@ -40,14 +56,8 @@ if not BOT_TOKEN:
     exit(1)
 
 # ===== ЛОГИРОВАНИЕ =====
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Запись в bot.log идет из отдельного потока, с ротацией и сжатием
+setup_logging(BOT_LOG_FILE or None)
 logger = logging.getLogger(__name__)
 
 # ===== ИНИЦИАЛИЗАЦИЯ БОТА =====
@@ -57,127 +67,46 @@ bot = Bot(
 )
 dp = Dispatcher()
 
-# ===== БАЗА ДАННЫХ =====
-def init_database():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('vpn.db')
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            is_active BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица платежей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER NOT NULL,
-            order_id TEXT UNIQUE NOT NULL,
-            amount INTEGER NOT NULL,
-            currency TEXT DEFAULT 'RUB',
-            status TEXT DEFAULT 'pending',
-            vpn_token TEXT UNIQUE,
-            payment_method TEXT DEFAULT 'SBP_QR',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP,
-            platega_order_id TEXT
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
+# Ограничение частоты действий пользователя (админ без ограничений)
+throttling = ThrottlingMiddleware(exempt=(ADMIN_ID,))
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+async def handler_metrics_middleware(handler, event: types.TelegramObject, data: dict):
+    """Время работы обработчика по его имени"""
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unhandled"
+        HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
+# Профилирование медленных апдейтов: сегменты БД, Platega и Telegram API (PROFILE_UPDATES=1)
+if PROFILE_UPDATES:
+    dp.update.outer_middleware(profiler.update_middleware)
+    bot.session.middleware(profiler.request_middleware)
+
+@dp.update.outer_middleware()
+async def log_context_middleware(handler, event: types.Update, data: dict):
+    """Помечает все записи лога при обработке апдейта его id и id пользователя"""
+    user = data.get("event_from_user")
+    with log_context(update_id=event.update_id, user_id=user.id if user else None):
+        return await handler(event, data)
 
+# ===== БАЗА ДАННЫХ =====
 # Инициализируем БД при запуске
 init_database()
 
-def get_db_connection():
-    """Получение соединения с базой данных"""
-    conn = sqlite3.connect('vpn.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-# ===== PLATEGA API (ИСПРАВЛЕННАЯ ВЕРСИЯ) =====
-class PlategaAPI:
-    def __init__(self):
-        self.api_key = PLATEGA_API_KEY
-        self.merchant_id = PLATEGA_MERCHANT_ID
-        self.base_url = "https://app.platega.io"
-        self.headers = {
-            "X-MerchantId": self.merchant_id,
-            "X-Secret": self.api_key,
-            "Content-Type": "application/json"
-        }
-        
-        if not self.api_key or not self.merchant_id:
-            logger.warning("⚠️ Ключи Platega не заданы полностью! Платежи не будут работать.")
-
-    async def create_payment(self, amount: int, order_id: str, description: str) -> Optional[str]:
-        """Создает платеж в Platega и возвращает ссылку для оплаты."""
-        url = f"{self.base_url}/transaction/process"
-
-        data = {
-            "paymentMethod": 2,  # 2 = СБП QR
-            "paymentDetails": {
-                "amount": float(amount),
-                "currency": "RUB"
-            },
-            "description": description,
-            "return": f"{WEB_URL}/success",
-            "failedUrl": f"{WEB_URL}/fail",
-            "payload": order_id
-        }
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers, timeout=30) as response:
-                    result_text = await response.text()
-                    logger.info(f"Ответ от Platega (статус {response.status}): {result_text}")
-                    
-                    if response.status == 200:
-                        result = json.loads(result_text)
-                        payment_url = result.get('redirect')
-                        if payment_url:
-                            logger.info(f"✅ Платеж создан. Ссылка: {payment_url}")
-                            return payment_url
-                        else:
-                            logger.error(f"❌ Platega не вернул ссылку. Ответ: {result}")
-                    else:
-                        logger.error(f"❌ Ошибка API Platega. Статус: {response.status}")
-                        logger.error(f"Тело ответа: {result_text}")
-        except aiohttp.ClientConnectorError as e:
-            logger.error(f"❌ Ошибка сети: {e}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка создания платежа: {e}")
-        return None
-
-    async def check_payment_status(self, transaction_id: str):
-        """Проверяет статус платежа в Platega по transactionId."""
-        url = f"{self.base_url}/transaction/{transaction_id}"
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers, timeout=10) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"Статус транзакции {transaction_id}: {result.get('status')}")
-                        return result
-                    else:
-                        logger.error(f"Ошибка при проверке статуса. Код: {response.status}")
-                        logger.error(await response.text())
-        except Exception as e:
-            logger.error(f"Ошибка сети при проверке статуса: {e}")
-        return None
-
+# ===== PLATEGA API =====
 platega = PlategaAPI()
+reconciler = PaymentReconciler(db, platega)
+invoices = InvoiceService(payments_repo, platega)
+user_registry = UserRegistry(users_repo)
+broadcaster = Broadcaster(bot, broadcasts_repo, users_repo, user_registry)
 
 # ===== ОБРАБОТЧИКИ КОМАНД =====
 @dp.message(Command("start"))
@@ -185,15 +114,8 @@ async def cmd_start(message: types.Message):
     """Обработчик команды /start"""
     user = message.from_user
     
-    # Сохраняем пользователя в БД
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR IGNORE INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)",
-        (user.id, user.username, user.first_name)
-    )
-    conn.commit()
-    conn.close()
+    # Сохраняем пользователя в БД (запись только для новых и изменивших профиль)
+    user_registry.touch(user.id, user.username, user.first_name)
     
     welcome_text = f"""
 🔐 <b>VPN Бот</b>
@@ -229,52 +151,66 @@ async def cmd_start(message: types.Message):
     
     await message.answer(welcome_text, reply_markup=keyboard)
 
+# Фоновые задачи создания счетов (ждем их завершения при остановке)
+_invoice_tasks: set = set()
+
 @dp.callback_query(F.data == "buy_vpn")
 async def process_buy(callback: types.CallbackQuery):
     """Обработка нажатия кнопки 'Купить VPN'"""
     user = callback.from_user
     await callback.answer()
     
-    # Создаем запись о платеже в БД
-    order_id = f"vpn_{user.id}_{int(datetime.now().timestamp())}"
-    vpn_token = str(uuid.uuid4())
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO payments (telegram_id, order_id, amount, vpn_token) VALUES (?, ?, ?, ?)",
-        (user.id, order_id, PRICE, vpn_token)
-    )
-    conn.commit()
-    conn.close()
-    
-    # Создаем платеж в Platega
+    # Счет создается в фоне, а это сообщение потом заменяется ссылкой на оплату
     loading_msg = await callback.message.answer("🔄 <b>Создаю ссылку для оплаты...</b>")
     
-    payment_url = await platega.create_payment(
-        amount=PRICE,
-        order_id=order_id,
-        description=f"VPN доступ для @{user.username or user.id} на {VPN_DURATION} дней"
-    )
-    
-    await loading_msg.delete()
+    task = asyncio.create_task(profiler.run("deliver_invoice", deliver_invoice(loading_msg, user), user_id=user.id))
+    _invoice_tasks.add(task)
+    task.add_done_callback(_invoice_task_done)
+
+def _invoice_task_done(task: asyncio.Task):
+    """Убирает задачу из набора и логирует ошибку (например, TelegramBadRequest при edit_text)"""
+    _invoice_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Ошибка выдачи счета", exc_info=task.exception())
+
+async def deliver_invoice(loading_msg: types.Message, user: types.User):
+    """Создает платеж в Platega (или берет еще действующий счет) и показывает ссылку вместо сообщения о загрузке"""
+    try:
+        invoice = await invoices.get_or_create(
+            telegram_id=user.id,
+            amount=PRICE,
+            description=f"VPN доступ для @{user.username or user.id} на {VPN_DURATION} дней"
+        )
+    except CircuitOpenError as e:
+        logger.warning(f"⚡ Счет для {user.id} не создан: {e}")
+        await loading_msg.edit_text(
+            "⏳ <b>Платежная система временно недоступна</b>\n\n"
+            f"Попробуйте еще раз через {max(int(e.retry_after), 1)} сек."
+        )
+        return
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания счета для {user.id}: {e}")
+        invoice = None
     
-    if payment_url:
+    if invoice:
+        order_id = invoice.order_id
+        title = f"Счет на {PRICE} руб. уже создан" if invoice.reused else f"Счет на {PRICE} руб. создан!"
+        
         # Кнопка для оплаты
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Оплатить через СБП QR", url=payment_url)],
+            [InlineKeyboardButton(text="💳 Оплатить через СБП QR", url=invoice.payment_url)],
             [InlineKeyboardButton(text="🔄 Проверить статус", callback_data=f"check_{order_id}")]
         ])
         
-        await callback.message.answer(
-            f"✅ <b>Счет на {PRICE} руб. создан!</b>\n\n"
+        await loading_msg.edit_text(
+            f"✅ <b>{title}</b>\n\n"
             f"<b>ID заказа:</b> <code>{order_id}</code>\n"
             f"<b>Метод оплаты:</b> СБП QR-код\n\n"
             "Нажмите кнопку ниже для оплаты. После успешной оплаты вы автоматически получите доступ к VPN.",
             reply_markup=keyboard
         )
     else:
-        await callback.message.answer(
+        await loading_msg.edit_text(
             "❌ <b>Не удалось создать платеж</b>\n\n"
             "Возможные причины:\n"
             "• Не настроен API ключ Platega\n"
@@ -283,19 +219,27 @@ async def process_buy(callback: types.CallbackQuery):
             "Проверьте настройки или попробуйте позже."
         )
 
+def payment_confirmed_message(vpn_token: str) -> tuple:
+    """Текст и клавиатура сообщения об успешной оплате"""
+    vpn_url = f"{WEB_URL}/vpn/{vpn_token}"
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🚀 Получить VPN доступ", url=vpn_url)]
+    ])
+    
+    text = (
+        f"✅ <b>Оплата подтверждена!</b>\n\n"
+        f"Ваш VPN доступ активирован на <b>{VPN_DURATION} дней</b>.\n\n"
+        f"Нажмите кнопку ниже, чтобы получить доступ:"
+    )
+    return text, keyboard
+
 @dp.callback_query(F.data.startswith("check_"))
 async def check_payment_status(callback: types.CallbackQuery):
     """Проверка статуса платежа"""
     order_id = callback.data.replace("check_", "")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT status, vpn_token FROM payments WHERE order_id = ?",
-        (order_id,)
-    )
-    payment = cursor.fetchone()
-    conn.close()
+    payment = await payments_repo.get_status(order_id)
     
     if not payment:
         await callback.answer("❌ Платеж не найден", show_alert=True)
@@ -306,18 +250,8 @@ async def check_payment_status(callback: types.CallbackQuery):
     
     if status == 'success':
         # Оплата успешна! Даем ссылку на VPN
-        vpn_url = f"{WEB_URL}/vpn/{vpn_token}"
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🚀 Получить VPN доступ", url=vpn_url)]
-        ])
-        
-        await callback.message.answer(
-            f"✅ <b>Оплата подтверждена!</b>\n\n"
-            f"Ваш VPN доступ активирован на <b>{VPN_DURATION} дней</b>.\n\n"
-            f"Нажмите кнопку ниже, чтобы получить доступ:",
-            reply_markup=keyboard
-        )
+        text, keyboard = payment_confirmed_message(vpn_token)
+        await callback.message.answer(text, reply_markup=keyboard)
         await callback.answer()
     
     elif status == 'pending':
@@ -356,48 +290,32 @@ async def show_status(callback: types.CallbackQuery):
     """Показать статус пользователя"""
     user = callback.from_user
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COUNT(*) as total_payments, SUM(CASE WHEN status = 'success' THEN 1 ELSE 0 END) as successful_payments FROM payments WHERE telegram_id = ?",
-        (user.id,)
-    )
-    stats = cursor.fetchone()
-    conn.close()
+    stats = await payments_repo.get_user_stats(user.id)
+    subscription = await users_repo.get_subscription(user.id)
+    if subscription and subscription['is_active'] and subscription['expires_at']:
+        expires = time.strftime('%d.%m.%Y', time.localtime(parse_timestamp(subscription['expires_at'])))
+        subscription_text = f"активна до {expires}"
+    else:
+        subscription_text = "не активна"
     
     status_text = f"""
 <b>📊 Ваш статус</b>
 
 👤 Пользователь: {user.first_name or 'N/A'}
 🆔 ID: {user.id}
-📅 Активных подписок: {stats['successful_payments'] if stats else 0}
+📅 Подписка: {subscription_text}
 💰 Всего платежей: {stats['total_payments'] if stats else 0}
 """
     await callback.message.answer(status_text, parse_mode="HTML")
     await callback.answer()
 
-@dp.message(Command("admin"))
-async def admin_panel(message: types.Message):
-    """Админ панель"""
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("⛔ У вас нет доступа к админ панели.")
-        return
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
+async def admin_panel_view() -> tuple:
+    """Текст и клавиатура главного экрана админ-панели"""
     # Базовая статистика для главного экрана
-    cursor.execute("SELECT COUNT(*) as total_users FROM users")
-    total_users = cursor.fetchone()['total_users']
-    
-    cursor.execute("SELECT COUNT(*) as total_payments FROM payments")
-    total_payments = cursor.fetchone()['total_payments']
-    
-    cursor.execute("SELECT SUM(amount) as revenue FROM payments WHERE status='success'")
-    revenue_result = cursor.fetchone()['revenue']
-    total_revenue = revenue_result if revenue_result else 0
-
-    conn.close()
+    stats = await stats_repo.get()
+    total_users = stats['users_total']
+    total_payments = stats['payments_total']
+    total_revenue = stats['revenue']
 
     admin_text = f"""
 <b>🛠️ Админ-панель</b>
@@ -408,15 +326,27 @@ async def admin_panel(message: types.Message):
 • 💰 Общая выручка: <b>{total_revenue} руб.</b>
 
 Используйте кнопки ниже для детальной информации.
+Сверка счетчиков с базой: /recount
+Рассылка всем пользователям: /broadcast текст
 """
     # Клавиатура с кнопками для админа
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Детальная статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_1")], # Начинаем с 1 страницы
+        [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_f")], # Начинаем с первой страницы
         [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_refresh")]
     ])
 
-    await message.answer(admin_text, reply_markup=keyboard)
+    return admin_text, keyboard
+
+@dp.message(Command("admin"))
+async def admin_panel(message: types.Message):
+    """Админ панель"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас нет доступа к админ панели.")
+        return
+
+    text, keyboard = await admin_panel_view()
+    await message.answer(text, reply_markup=keyboard)
 
 # --- Обработчики админ-меню ---
 @dp.callback_query(F.data == "admin_stats")
@@ -426,30 +356,15 @@ async def send_admin_stats(callback: types.CallbackQuery):
         await callback.answer("⛔ Доступ запрещен.", show_alert=True)
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Развернутая статистика
-    cursor.execute("SELECT COUNT(*) as total FROM users")
-    total_users = cursor.fetchone()['total']
-    
-    cursor.execute("SELECT COUNT(*) as active FROM users WHERE is_active = 1")
-    active_users = cursor.fetchone()['active']
-    
-    cursor.execute("SELECT COUNT(*) as total_orders FROM payments")
-    total_orders = cursor.fetchone()['total_orders']
-    
-    cursor.execute("SELECT COUNT(*) as success_orders FROM payments WHERE status='success'")
-    success_orders = cursor.fetchone()['success_orders']
-    
-    cursor.execute("SELECT COUNT(*) as pending_orders FROM payments WHERE status='pending'")
-    pending_orders = cursor.fetchone()['pending_orders']
-    
-    cursor.execute("SELECT SUM(amount) as revenue FROM payments WHERE status='success'")
-    revenue_result = cursor.fetchone()['revenue']
-    total_revenue = revenue_result if revenue_result else 0
-
-    conn.close()
+    stats = await stats_repo.get()
+    total_users = stats['users_total']
+    active_users = stats['users_active']
+    total_orders = stats['payments_total']
+    success_orders = stats['payments_success']
+    pending_orders = stats['payments_pending']
+    total_revenue = stats['revenue']
+    breaker = platega.breaker.stats
 
     stats_text = f"""
 <b>📊 Детальная статистика</b>
@@ -463,11 +378,40 @@ async def send_admin_stats(callback: types.CallbackQuery):
 • Успешных: <b>{success_orders}</b>
 • Ожидают оплаты: <b>{pending_orders}</b>
 • Выручка: <b>{total_revenue} руб.</b>
+
+<u>Platega:</u>
+• Автомат защиты: <b>{breaker['state']}</b> (размыканий: {breaker['opened']}, отказов: {breaker['rejected']})
 """
     await callback.message.edit_text(stats_text, parse_mode="HTML")
     await callback.answer()
 
 
+USERS_PER_PAGE = 10
+
+def _b36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, rest = divmod(number, 36)
+        result = digits[rest] + result
+        if not number:
+            return result
+
+def users_cursor(direction: str, page: int, user_id: int) -> str:
+    """callback_data страницы списка: n - дальше (id меньше), p - назад (id больше)"""
+    return f"admin_users_{direction}{_b36(page)}.{_b36(user_id)}"
+
+def parse_users_cursor(data: str) -> tuple:
+    """admin_users_f | admin_users_l | admin_users_<n|p><страница>.<id> -> (направление, страница, id)"""
+    cursor = data[len("admin_users_"):]
+    if cursor[:1] in ("n", "p") and "." in cursor:
+        page, user_id = cursor[1:].split(".", 1)
+        return cursor[0], int(page, 36), int(user_id, 36)
+    if cursor == "l":
+        return "l", 0, 0
+    return "f", 1, 0
+
+
 @dp.callback_query(F.data.startswith("admin_users_"))
 async def send_users_list(callback: types.CallbackQuery):
     """Отправляет список пользователей с пагинацией только админу."""
@@ -475,28 +419,28 @@ async def send_users_list(callback: types.CallbackQuery):
         await callback.answer("⛔ Доступ запрещен.", show_alert=True)
         return
 
-    page = int(callback.data.split("_")[2])  # Получаем номер страницы из callback_data
-    users_per_page = 10
-    offset = (page - 1) * users_per_page
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Получаем пользователей для текущей страницы
-    cursor.execute("SELECT telegram_id, username, first_name, is_active, created_at FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (users_per_page, offset))
-    users = cursor.fetchall()
-    
-    # Считаем общее количество для пагинации
-    cursor.execute("SELECT COUNT(*) as count FROM users")
-    total_users = cursor.fetchone()['count']
+    # Курсор из callback_data: каждая страница читается по индексу id, без OFFSET
+    direction, page, user_id = parse_users_cursor(callback.data)
     
-    conn.close()
+    # Общее количество для пагинации (из счетчиков)
+    total_users = (await stats_repo.get())['users_total']
+    total_pages = max(1, -(-total_users // USERS_PER_PAGE))
+
+    if direction == "n":
+        users = await users_repo.get_page(USERS_PER_PAGE, before_id=user_id)
+    elif direction == "p":
+        users = await users_repo.get_page(USERS_PER_PAGE, after_id=user_id)
+    elif direction == "l":
+        page = total_pages
+        users = await users_repo.get_last_page(total_users - (total_pages - 1) * USERS_PER_PAGE)
+    else:
+        users = await users_repo.get_page(USERS_PER_PAGE)
 
     if not users:
         await callback.answer("Список пользователей пуст.", show_alert=True)
         return
 
-    users_text = f"<b>👥 Список пользователей (Страница {page})</b>\n\n"
+    users_text = f"<b>👥 Список пользователей (Страница {page} из {total_pages})</b>\n\n"
     for user in users:
         status = "🟢" if user['is_active'] else "⚪"
         username = f"@{user['username']}" if user['username'] else "—"
@@ -505,9 +449,11 @@ async def send_users_list(callback: types.CallbackQuery):
     # Формируем клавиатуру пагинации
     keyboard_buttons = []
     if page > 1:
-        keyboard_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_users_{page-1}"))
-    if offset + users_per_page < total_users:
-        keyboard_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_users_{page+1}"))
+        keyboard_buttons.append(InlineKeyboardButton(text="⏮", callback_data="admin_users_f"))
+        keyboard_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=users_cursor("p", page - 1, users[0]['id'])))
+    if page < total_pages:
+        keyboard_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=users_cursor("n", page + 1, users[-1]['id'])))
+        keyboard_buttons.append(InlineKeyboardButton(text="⏭", callback_data="admin_users_l"))
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[keyboard_buttons]) if keyboard_buttons else None
 
@@ -515,17 +461,225 @@ async def send_users_list(callback: types.CallbackQuery):
     await callback.answer()
 
 
+@dp.message(Command("recount"))
+async def recount_stats(message: types.Message):
+    """Сверяет счетчики админки с полным пересчетом и перестраивает их при расхождении"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас нет доступа к админ панели.")
+        return
+
+    mismatches = await stats_repo.verify()
+    if not mismatches:
+        await message.answer("✅ Счетчики совпадают с полным пересчетом.")
+        return
+
+    await stats_repo.rebuild()
+    lines = "\n".join(
+        f"• {name}: было <b>{counter}</b>, стало <b>{actual}</b>"
+        for name, (counter, actual) in sorted(mismatches.items())
+    )
+    logger.warning(f"⚠️ Счетчики админки перестроены: {mismatches}")
+    await message.answer(f"🔧 <b>Счетчики перестроены</b>\n\n{lines}")
+
+
 @dp.callback_query(F.data == "admin_refresh")
 async def refresh_admin_panel(callback: types.CallbackQuery):
     """Обновляет админ-панель."""
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ Доступ запрещен.", show_alert=True)
         return
-    # Просто повторно вызываем команду /admin
-    await admin_panel(callback.message)
+    # Права проверены по нажавшему кнопку: отправитель callback.message - сам бот
+    text, keyboard = await admin_panel_view()
+    await callback.message.answer(text, reply_markup=keyboard)
     await callback.answer()
 
+# --- Рассылка ---
+@dp.message(Command("broadcast"))
+async def broadcast_draft(message: types.Message):
+    """Черновик рассылки: текст после команды (с форматированием) и кнопки подтверждения"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ У вас нет доступа к админ панели.")
+        return
+
+    parts = message.html_text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await message.answer("Использование: <code>/broadcast текст сообщения</code>")
+        return
+    if broadcaster.active:
+        await message.answer(f"⏳ Уже идет рассылка #{broadcaster.job.id}. Дождитесь ее окончания или остановите.")
+        return
+
+    broadcast_id = await broadcasts_repo.create(text, message.chat.id)
+    recipients = await users_repo.count_recipients()
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Отправить", callback_data=f"bc_start_{broadcast_id}"),
+        InlineKeyboardButton(text="✖️ Отмена", callback_data=f"bc_cancel_{broadcast_id}")
+    ]])
+    await message.answer(
+        f"📣 <b>Рассылка #{broadcast_id}</b>\n\n{text}\n\n"
+        f"Получателей: <b>{recipients}</b>. Отправить?",
+        reply_markup=keyboard
+    )
+
+@dp.callback_query(F.data.startswith("bc_"))
+async def broadcast_control(callback: types.CallbackQuery):
+    """Запуск, отмена черновика и остановка рассылки"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Доступ запрещен.", show_alert=True)
+        return
+
+    _, action, broadcast_id = callback.data.split("_", 2)
+    broadcast_id = int(broadcast_id)
+    if action == "start":
+        if await broadcaster.launch(broadcast_id, callback.message.message_id):
+            await callback.message.edit_text(f"📣 <b>Рассылка #{broadcast_id}</b>: запускается...")
+            await callback.answer("Рассылка запущена")
+        else:
+            await callback.answer("Рассылка уже запущена, отменена или идет другая", show_alert=True)
+    elif action == "cancel":
+        if await broadcasts_repo.cancel_draft(broadcast_id):
+            await callback.message.edit_text(f"✖️ Рассылка #{broadcast_id} отменена.")
+        await callback.answer()
+    elif action == "stop":
+        stopped = broadcaster.cancel(broadcast_id)
+        await callback.answer("Останавливаю рассылку..." if stopped else "Рассылка уже завершена")
+
+# ===== СОБЫТИЯ OUTBOX =====
+async def handle_outbox_event(event: str, payload: dict):
+    """Отправляет пользователю ссылку на VPN сразу после подтверждения оплаты.
+
+    Исключение отсюда повторяет событие целиком, поэтому после отправки ничего не должно падать.
+    """
+    if event == PAYMENT_CONFIRMED:
+        text, keyboard = payment_confirmed_message(payload['vpn_token'])
+        await bot.send_message(payload['telegram_id'], text, reply_markup=keyboard)
+        logger.info(f"📬 Пользователю {payload['telegram_id']} отправлено подтверждение заказа {payload['order_id']}")
+        # Срок продлил триггер в базе; планировщику нужно узнать новую дату (иначе подхватит перезагрузка)
+        try:
+            await subscriptions.add(payload['telegram_id'])
+        except Exception as e:
+            logger.error(f"❌ Планировщик подписок не обновлен для {payload['telegram_id']}: {e}")
+
+outbox_consumer = OutboxConsumer(db, handle_outbox_event)
+
+# ===== ПОДПИСКИ =====
+async def notify_subscription(event: str, telegram_id: int, expires_at: float):
+    """Напоминание о продлении и сообщение об окончании подписки"""
+    expires = time.strftime('%d.%m.%Y', time.localtime(expires_at))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🛒 Продлить", callback_data="buy_vpn")]
+    ])
+    if event == REMIND:
+        text = f"🔔 Ваша подписка на VPN закончится <b>{expires}</b>.\n\nПродлите ее заранее, чтобы доступ не прервался."
+    else:
+        text = f"⌛ Ваша подписка на VPN закончилась {expires}.\n\nЧтобы снова пользоваться VPN, оплатите доступ."
+    await bot.send_message(telegram_id, text, reply_markup=keyboard, parse_mode="HTML")
+
+subscriptions = SubscriptionScheduler(users_repo, notify_subscription)
+
 # ===== ЗАПУСК БОТА =====
+# ===== МЕТРИКИ =====
+metrics_runner = None
+
+async def collect_bot_metrics() -> list:
+    """Состояние автомата защиты Platega и отклонения троттлинга"""
+    breaker = platega.breaker.stats
+    return (
+        gauge_lines('platega_breaker_open', 'Автомат защиты Platega разомкнут (1) или замкнут (0)',
+                    {(): int(breaker['state'] != 'closed')})
+        + gauge_lines('platega_breaker_opened', 'Сколько раз автомат размыкался', {(): breaker['opened']})
+        + gauge_lines('platega_breaker_rejected', 'Вызовов Platega отклонено автоматом', {(): breaker['rejected']})
+        + gauge_lines('bot_throttled', 'Отклонено троттлингом по типам действий',
+                      {(action,): count for action, count in throttling.rejected.items()}, ('action',))
+    )
+
+add_collector(collect_bot_metrics)
+
+@dp.startup()
+async def on_startup():
+    """Открывает общие ресурсы при старте"""
+    global metrics_runner
+    if PROFILE_UPDATES:
+        profiler.start()
+    await platega.start()
+    await user_registry.start()
+    await broadcaster.start()
+    await subscriptions.start()
+    await outbox_consumer.start()
+    reconciler.start()
+    if BOT_MODE != "webhook" and BOT_METRICS_PORT:
+        # В режиме webhook метрики бота отдает /metrics веб-сервера
+        metrics_runner = await start_metrics_server()
+
+@dp.shutdown()
+async def on_shutdown():
+    """Останавливает фоновые задачи, закрывает HTTP-сессию и пул соединений с БД"""
+    global metrics_runner
+    await reconciler.stop()
+    if _invoice_tasks:
+        await asyncio.gather(*_invoice_tasks, return_exceptions=True)
+    await broadcaster.stop()
+    await outbox_consumer.stop()
+    await subscriptions.stop()
+    await user_registry.stop()
+    await platega.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    profiler.stop()
+    await db.close()
+
+# ===== WEBHOOK (ОДИН ПРОЦЕСС С ВЕБ-СЕРВЕРОМ) =====
+_webhook_tasks: set = set()
+
+def setup_webhook(app):
+    """Подключает бота к FastAPI app: маршрут для обновлений и запуск/остановка вместе с сервером"""
+    import web_server
+    
+    @app.post(WEBHOOK_PATH, include_in_schema=False)
+    async def telegram_webhook(request: Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        # Отвечаем Telegram сразу, обработка идет в фоне
+        task = asyncio.create_task(dp.feed_update(bot, update))
+        _webhook_tasks.add(task)
+        task.add_done_callback(_webhook_tasks.discard)
+        return Response(status_code=200)
+    
+    async def start_bot():
+        await dp.emit_startup(bot=bot)
+        await bot.set_webhook(
+            f"{WEB_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"🔗 Webhook установлен: {WEB_URL}{WEBHOOK_PATH}")
+    
+    async def stop_bot():
+        if _webhook_tasks:
+            await asyncio.gather(*_webhook_tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+    
+    web_server.startup_hooks.append(start_bot)
+    web_server.shutdown_hooks.append(stop_bot)
+
+async def run_webhook():
+    """Бот и веб-сервер в одном процессе: общий event loop, пул БД и HTTP-клиенты"""
+    import uvicorn
+    import web_server
+    
+    setup_webhook(web_server.app)
+    server = uvicorn.Server(uvicorn.Config(
+        web_server.app,
+        host=web_server.WEB_HOST,
+        port=web_server.WEB_PORT,
+        log_level="info"
+    ))
+    await server.serve()
+
 async def main():
     """Основная функция запуска бота"""
     logger.info("✅ База данных инициализирована")
@@ -538,6 +692,11 @@ async def main():
     else:
         logger.warning("Platega API: Не настроен! Платежи работать не будут")
     
+    if BOT_MODE == "webhook":
+        logger.info("Режим: webhook (бот и веб-сервер в одном процессе)")
+        await run_webhook()
+        return
+    
     # Очистка кэша
     await bot.delete_webhook(drop_pending_updates=True)
     
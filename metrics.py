@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Метрики в текстовом формате Prometheus
+
+Гистограммы задержек (обработчики aiogram, классы SQL-запросов, методы
+Platega, HTTP-маршруты) и счетчики. Значения обновляются только из
+потока event loop, поэтому блокировки не нужны: observe() - это поиск
+корзины и пара сложений. Значения, которые дешевле прочитать в момент
+опроса (счетчики платежей из базы, состояние автомата защиты), отдают
+коллекторы.
+"""
+
+import os
+import bisect
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List
+
+# Конфигурация
+BOT_METRICS_HOST = os.getenv('BOT_METRICS_HOST', '127.0.0.1')
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', '9101'))
+
+# Границы корзин, секунды: от быстрых SQL-запросов до медленных ответов Platega
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+_metrics: list = []
+_collectors: List[Callable[[], Awaitable[List[str]]]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._values: Dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def gauge_lines(name: str, help: str, samples: dict, labelnames: tuple = ()) -> List[str]:
+    """Строки gauge для коллектора: samples = {значения меток: значение}"""
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+    for labels, value in samples.items():
+        lines.append(f'{name}{_labels(labelnames, labels)} {value}')
+    return lines
+
+
+def add_collector(collector: Callable[[], Awaitable[List[str]]]):
+    """Регистрирует async-функцию, которая возвращает строки метрик в момент опроса"""
+    _collectors.append(collector)
+
+
+async def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            lines.extend(await collector())
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора метрик: {e}")
+    return '\n'.join(lines) + '\n'
+
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+
+def statement_class(sql: str) -> str:
+    """Класс запроса для метки: "SELECT payments", "UPDATE outbox" и т.п."""
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else '?'
+    match = _SQL_TABLE.search(sql)
+    return f'{verb} {match.group(1)}' if match else verb
+
+
+# ===== МЕТРИКИ =====
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Время обработчика aiogram', ('handler',))
+DB_LATENCY = Histogram('db_query_seconds', 'Время запроса к SQLite (с ожиданием пула)', ('statement',))
+DB_BUSY_RETRIES = Counter('db_busy_retries_total', 'Повторы транзакций SQLite из-за блокировки другим писателем', ('statement',))
+DB_BUSY_WAIT = Counter('db_busy_wait_seconds_total', 'Время ожидания блокировки SQLite', ('statement',))
+DB_LOCKED = Counter('db_locked_total', 'Транзакции, не дождавшиеся блокировки (database is locked)', ('statement',))
+PLATEGA_LATENCY = Histogram('platega_request_seconds', 'Время ответа Platega по методам', ('method',))
+HTTP_LATENCY = Histogram('http_request_seconds', 'Время обработки HTTP-запроса', ('method', 'route', 'status'))
+CALLBACKS = Counter('platega_callbacks_total', 'Callback Platega по результату обработки', ('outcome',))
+PAYMENT_TRANSITIONS = Counter('payment_transitions_total', 'Переходы платежей в финальный статус', ('status', 'source'))
+BROADCAST_MESSAGES = Counter('broadcast_messages_total', 'Сообщения рассылок по результату', ('outcome',))
+
+
+# ===== HTTP-СЕРВЕР ДЛЯ ПРОЦЕССА БОТА =====
+async def start_metrics_server(host: str = BOT_METRICS_HOST, port: int = BOT_METRICS_PORT):
+    """Отдает /metrics из процесса бота (в режиме polling у него нет своего HTTP-сервера)"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=await render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики бота: http://{host}:{port}/metrics")
+    return runner
+
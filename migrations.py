@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Версионированные миграции схемы базы данных
+
+Каждая миграция применяется один раз в отдельной транзакции, номер
+применённой версии записывается в schema_migrations и PRAGMA user_version.
+Запуск: python migrations.py [путь к базе]
+"""
+
+import os
+import logging
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS: list = []
+
+
+def migration(version: int, name: str):
+    """Регистрирует функцию fn(conn) как миграцию с указанным номером"""
+    def decorator(fn: Callable):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет (базы, созданные старым кодом, расходятся)"""
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# ===== МИГРАЦИИ =====
+@migration(1, "initial schema")
+def _initial_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            is_active BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            order_id TEXT UNIQUE NOT NULL,
+            amount INTEGER NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            status TEXT DEFAULT 'pending',
+            vpn_token TEXT UNIQUE,
+            payment_method TEXT DEFAULT 'SBP_QR',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )
+    ''')
+
+
+@migration(2, "payments.platega_order_id")
+def _platega_order_id(conn):
+    add_column(conn, "payments", "platega_order_id", "TEXT")
+
+
+@migration(3, "hot-path indexes")
+def _hot_path_indexes(conn):
+    # show_status: COUNT/SUM по платежам пользователя в разрезе статуса
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(telegram_id, status)")
+    # Админка: COUNT по статусу и SUM(amount) для status='success' без чтения таблицы
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_amount ON payments(status, amount)")
+    # Админка: число активных пользователей
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active) WHERE is_active = 1")
+    conn.execute("ANALYZE")
+
+
+@migration(4, "pending payments index")
+def _pending_payments_index(conn):
+    # Сверка платежей: свежие pending-платежи с известным ID транзакции Platega
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending_created ON payments(created_at)
+        WHERE status = 'pending' AND platega_order_id IS NOT NULL
+    ''')
+
+
+@migration(5, "outbox")
+def _outbox(conn):
+    # События для бота, записываемые в одной транзакции с изменением платежа
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_undelivered ON outbox(id) WHERE delivered_at IS NULL")
+
+
+def _bump(name_sql: str, delta_sql: str) -> str:
+    """SQL для триггера: прибавить delta к счетчику name (создав его при необходимости)"""
+    return (
+        f"INSERT INTO counters (name, value) VALUES ({name_sql}, {delta_sql}) "
+        f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;"
+    )
+
+
+COUNTER_TRIGGERS = {
+    "trg_users_insert": f"""
+        AFTER INSERT ON users BEGIN
+            {_bump("'users_total'", "1")}
+            {_bump("'users_active'", "NEW.is_active = 1")}
+        END""",
+    "trg_users_delete": f"""
+        AFTER DELETE ON users BEGIN
+            {_bump("'users_total'", "-1")}
+            {_bump("'users_active'", "-(OLD.is_active = 1)")}
+        END""",
+    "trg_users_active": f"""
+        AFTER UPDATE OF is_active ON users WHEN (OLD.is_active = 1) IS NOT (NEW.is_active = 1) BEGIN
+            {_bump("'users_active'", "(NEW.is_active = 1) - (OLD.is_active = 1)")}
+        END""",
+    "trg_payments_insert": f"""
+        AFTER INSERT ON payments BEGIN
+            {_bump("'payments_total'", "1")}
+            {_bump("'payments_' || NEW.status", "1")}
+            {_bump("'revenue'", "CASE WHEN NEW.status = 'success' THEN NEW.amount ELSE 0 END")}
+        END""",
+    "trg_payments_delete": f"""
+        AFTER DELETE ON payments BEGIN
+            {_bump("'payments_total'", "-1")}
+            {_bump("'payments_' || OLD.status", "-1")}
+            {_bump("'revenue'", "CASE WHEN OLD.status = 'success' THEN -OLD.amount ELSE 0 END")}
+        END""",
+    "trg_payments_update": f"""
+        AFTER UPDATE OF status, amount ON payments
+        WHEN OLD.status IS NOT NEW.status OR OLD.amount IS NOT NEW.amount BEGIN
+            {_bump("'payments_' || OLD.status", "-1")}
+            {_bump("'payments_' || NEW.status", "1")}
+            {_bump("'revenue'", "CASE WHEN NEW.status = 'success' THEN NEW.amount ELSE 0 END - CASE WHEN OLD.status = 'success' THEN OLD.amount ELSE 0 END")}
+        END""",
+}
+
+
+def recount_counters(conn: sqlite3.Connection) -> dict:
+    """Полный пересчет агрегатов по таблицам (эталон для счетчиков)"""
+    counters = {
+        'users_total': conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+        'users_active': conn.execute("SELECT COUNT(*) FROM users WHERE is_active = 1").fetchone()[0],
+        'payments_total': conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0],
+        'revenue': conn.execute("SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'success'").fetchone()[0],
+    }
+    for status, count in conn.execute("SELECT status, COUNT(*) FROM payments GROUP BY status"):
+        counters[f'payments_{status}'] = count
+    return counters
+
+
+def rebuild_counters(conn: sqlite3.Connection) -> dict:
+    """Перестраивает таблицу counters с нуля"""
+    counters = recount_counters(conn)
+    conn.execute("DELETE FROM counters")
+    conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?)", counters.items())
+    return counters
+
+
+@migration(6, "admin counters")
+def _admin_counters(conn):
+    # Агрегаты для админки, поддерживаемые триггерами при каждой записи
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for name, body in COUNTER_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"CREATE TRIGGER {name} {body}")
+    rebuild_counters(conn)
+
+
+@migration(7, "payments invoice url")
+def _invoice_url(conn):
+    # Ссылка на оплату и срок ее действия: повторное нажатие "Купить" переиспользует счет
+    add_column(conn, "payments", "payment_url", "TEXT")
+    add_column(conn, "payments", "expires_at", "TIMESTAMP")
+
+
+@migration(8, "broadcasts")
+def _broadcasts(conn):
+    # Пользователи, заблокировавшие бота: рассылка их пропускает, /start снимает отметку
+    add_column(conn, "users", "is_blocked", "INTEGER DEFAULT 0")
+    # Рассылки админа; cursor_id - последний обработанный users.id (продолжение после перезапуска)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            admin_chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            cursor_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+
+def _extend_subscription(when: str) -> str:
+    """Триггер: успешная оплата продлевает подписку на duration_days от max(now, expires_at)"""
+    return f"""
+        {when} BEGIN
+            INSERT INTO users (telegram_id, is_active, expires_at)
+            VALUES (NEW.telegram_id, 1, datetime('now', '+' || NEW.duration_days || ' days'))
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                is_active = 1,
+                reminded = 0,
+                expires_at = datetime(MAX(COALESCE(expires_at, ''), datetime('now')), '+' || NEW.duration_days || ' days');
+        END"""
+
+
+SUBSCRIPTION_TRIGGERS = {
+    "trg_subscription_paid": _extend_subscription(
+        "AFTER UPDATE OF status ON payments WHEN NEW.status = 'success' AND OLD.status IS NOT 'success'"
+    ),
+    "trg_subscription_paid_insert": _extend_subscription(
+        "AFTER INSERT ON payments WHEN NEW.status = 'success'"
+    ),
+}
+
+
+@migration(9, "subscriptions")
+def _subscriptions(conn):
+    duration = int(os.getenv('VPN_DURATION', '30'))
+    # Срок подписки, оплаченный платежом (цена может меняться вместе со сроком)
+    add_column(conn, "payments", "duration_days", f"INTEGER NOT NULL DEFAULT {duration}")
+    # Подписка пользователя: до какого времени (UTC) и отправлено ли напоминание о продлении
+    add_column(conn, "users", "expires_at", "TIMESTAMP")
+    add_column(conn, "users", "reminded", "INTEGER NOT NULL DEFAULT 0")
+
+    # Сроки для уже оплаченных подписок: платежи по порядку, каждый продлевает от max(оплата, срок)
+    expires = {}
+    for telegram_id, paid_at, days in conn.execute('''
+        SELECT telegram_id, COALESCE(completed_at, created_at), duration_days FROM payments
+        WHERE status = 'success' ORDER BY COALESCE(completed_at, created_at)
+    '''):
+        paid = datetime.strptime(paid_at, '%Y-%m-%d %H:%M:%S')
+        expires[telegram_id] = max(expires.get(telegram_id, paid), paid) + timedelta(days=days)
+    now = datetime.utcnow()
+    for telegram_id, until in expires.items():
+        conn.execute('''
+            INSERT INTO users (telegram_id, is_active, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET is_active = excluded.is_active, expires_at = excluded.expires_at
+        ''', (telegram_id, int(until > now), until.strftime('%Y-%m-%d %H:%M:%S')))
+
+    for name, body in SUBSCRIPTION_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"CREATE TRIGGER {name} {body}")
+    # Планировщик истечений: ближайшие сроки активных подписок и еще не напомненные
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry ON users(expires_at) WHERE is_active = 1")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_renewal ON users(expires_at) WHERE is_active = 1 AND reminded = 0")
+
+
+@migration(10, "outbox_retry")
+def _outbox_retry(conn):
+    # Повторы с экспоненциальной задержкой; отброшенные события отдельно от доставленных
+    add_column(conn, "outbox", "next_attempt_at", "TIMESTAMP")
+    add_column(conn, "outbox", "failed_at", "TIMESTAMP")
+    conn.execute("DROP INDEX IF EXISTS idx_outbox_undelivered")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(id) WHERE delivered_at IS NULL AND failed_at IS NULL")
+
+
+# ===== ДВИЖОК =====
+def current_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path: str, target: Optional[int] = None) -> int:
+    """Применяет недостающие миграции до target (по умолчанию до последней)"""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        # WAL сохраняется в файле базы: один раз здесь, а не при каждом новом соединении под нагрузкой
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for version, name, fn in MIGRATIONS:
+            if target is not None and version > target:
+                break
+            # BEGIN IMMEDIATE сериализует бота и веб-сервер, стартующих одновременно
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if current_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                fn(conn)
+                conn.execute("INSERT OR REPLACE INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                logger.error(f"❌ Миграция {version} ({name}) не применена")
+                raise
+            logger.info(f"✅ Применена миграция {version}: {name}")
+        return current_version(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'vpn.db'
+    print(f"Версия схемы: {migrate(db_path)}")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Надежная доставка событий от веб-сервера к боту (outbox в SQLite)
+
+Событие записывается в таблицу outbox в той же транзакции, что и
+изменение платежа. После коммита отправитель будит потребителя
+датаграммой в Unix-сокет; если бот не запущен или сигнал потерялся,
+событие заберет периодический опрос таблицы. Недоставленное событие
+повторяется с экспоненциальной задержкой (next_attempt_at), поэтому
+короткий сбой Telegram не исчерпывает попытки; после OUTBOX_MAX_ATTEMPTS
+событие помечается failed_at и остается в таблице для разбора.
+"""
+
+import os
+import asyncio
+import json
+import logging
+import socket
+import sqlite3
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+# Конфигурация
+OUTBOX_SOCKET = os.getenv('OUTBOX_SOCKET', 'outbox.sock')
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '12'))
+# Задержка повтора: OUTBOX_RETRY_BASE * 2^попытка, не больше OUTBOX_RETRY_MAX (12 попыток - около часа)
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '5'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '600'))
+
+PAYMENT_CONFIRMED = 'payment_confirmed'
+
+logger = logging.getLogger(__name__)
+
+# Потребитель в текущем процессе (будится напрямую, без сокета)
+_local_consumer: Optional["OutboxConsumer"] = None
+
+
+def enqueue(conn: sqlite3.Connection, event: str, payload: dict):
+    """Добавляет событие в outbox внутри текущей транзакции"""
+    conn.execute(
+        "INSERT INTO outbox (event, payload) VALUES (?, ?)",
+        (event, json.dumps(payload, ensure_ascii=False))
+    )
+
+
+def notify(path: str = OUTBOX_SOCKET):
+    """Будит потребителя после коммита; ошибки не важны - сработает опрос"""
+    if _local_consumer is not None:
+        _local_consumer.wake()
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(b'1', path)
+    except OSError:
+        pass
+
+
+class _WakeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, consumer: "OutboxConsumer"):
+        self.consumer = consumer
+
+    def datagram_received(self, data, addr):
+        self.consumer.wake()
+
+
+class OutboxConsumer:
+    """Читает недоставленные события и передает их обработчику handler(event, payload)"""
+
+    def __init__(
+        self,
+        db,
+        handler: Callable[[str, dict], Awaitable[None]],
+        socket_path: str = OUTBOX_SOCKET,
+        poll_interval: float = OUTBOX_POLL_INTERVAL
+    ):
+        self.db = db
+        self.handler = handler
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._transport = None
+        self._task = None
+        # До этого момента (monotonic) Telegram просил не отправлять
+        self._paused_until = 0.0
+        self.stats = {'delivered': 0, 'failed': 0, 'dropped': 0}
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def start(self):
+        global _local_consumer
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _WakeProtocol(self),
+                local_addr=self.socket_path,
+                family=socket.AF_UNIX
+            )
+        except OSError as e:
+            logger.warning(f"⚠️ Сокет outbox недоступен ({e}), события будут забираться опросом")
+        _local_consumer = self
+        self._task = asyncio.create_task(self._loop())
+        logger.info("📬 Потребитель outbox запущен")
+
+    async def stop(self):
+        global _local_consumer
+        if _local_consumer is self:
+            _local_consumer = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    async def _loop(self):
+        while True:
+            try:
+                # Следующая пачка сразу - только если предыдущая полная и доставлена целиком
+                while await self.drain() == OUTBOX_BATCH:
+                    pass
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self) -> int:
+        """Обрабатывает одну пачку событий, срок повтора которых наступил; возвращает число доставленных"""
+        if time.monotonic() < self._paused_until:
+            return 0
+        rows = await self.db.fetchall(
+            """
+            SELECT id, event, payload, attempts FROM outbox INDEXED BY idx_outbox_pending
+            WHERE delivered_at IS NULL AND failed_at IS NULL
+              AND (next_attempt_at IS NULL OR next_attempt_at <= datetime('now'))
+            ORDER BY id LIMIT ?
+            """,
+            (OUTBOX_BATCH,)
+        )
+        delivered, retry, dropped = 0, [], []
+        try:
+            for row in rows:
+                try:
+                    await self.handler(row['event'], json.loads(row['payload']))
+                except TelegramRetryAfter as e:
+                    # Флуд-контроль - не ошибка события: попытку не считаем, остаток пачки ждет следующего опроса
+                    logger.warning(f"⏳ Outbox: Telegram просит подождать {e.retry_after} с")
+                    retry.append((row['attempts'], e.retry_after, row['id']))
+                    self._paused_until = time.monotonic() + e.retry_after
+                    break
+                except TelegramForbiddenError as e:
+                    # Пользователь заблокировал бота: повтор ничего не изменит
+                    logger.warning(f"🚫 Событие outbox {row['id']} отброшено: {e}")
+                    dropped.append(row['id'])
+                    self.stats['dropped'] += 1
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    attempts = row['attempts'] + 1
+                    if attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logger.error(f"❌ Событие outbox {row['id']} отброшено после {OUTBOX_MAX_ATTEMPTS} попыток: {e}")
+                        dropped.append(row['id'])
+                        self.stats['dropped'] += 1
+                    else:
+                        delay = min(OUTBOX_RETRY_BASE * 2 ** row['attempts'], OUTBOX_RETRY_MAX)
+                        logger.warning(f"⚠️ Событие outbox {row['id']} не доставлено, повтор через {delay:.0f} с: {e}")
+                        retry.append((attempts, delay, row['id']))
+                else:
+                    # Отмечаем сразу: сбой или остановка дальше по пачке не должны повторить уже отправленное
+                    await self.db.run(self._mark, [row['id']], [], [])
+                    delivered += 1
+                    self.stats['delivered'] += 1
+        finally:
+            if retry or dropped:
+                await self.db.run(self._mark, [], retry, dropped)
+        return delivered
+
+    @staticmethod
+    def _mark(conn, done: list, retry: list, dropped: list):
+        conn.executemany("UPDATE outbox SET delivered_at = CURRENT_TIMESTAMP WHERE id = ?", [(i,) for i in done])
+        conn.executemany(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = datetime('now', '+' || ? || ' seconds') WHERE id = ?",
+            retry
+        )
+        conn.executemany("UPDATE outbox SET failed_at = CURRENT_TIMESTAMP WHERE id = ?", [(i,) for i in dropped])
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Клиент Platega API (СБП QR) с долгоживущей HTTP-сессией
+
+Одна сессия создается при старте бота и закрывается при остановке:
+keep-alive соединения и кэш DNS избавляют каждый счет от нового
+TCP/TLS рукопожатия.
+"""
+
+import os
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+import profiler
+from metrics import PLATEGA_LATENCY
+from resilience import CircuitBreaker, retry_delay
+
+load_dotenv()
+
+# Конфигурация
+PLATEGA_API_KEY = os.getenv('PLATEGA_API_KEY', '')
+PLATEGA_MERCHANT_ID = os.getenv('PLATEGA_MERCHANT_ID', '')
+PLATEGA_BASE_URL = os.getenv('PLATEGA_BASE_URL', 'https://app.platega.io')
+WEB_URL = os.getenv('WEB_URL', 'https://secureprodaww.ru')
+PLATEGA_CONN_LIMIT = int(os.getenv('PLATEGA_CONN_LIMIT', '20'))
+PLATEGA_DNS_TTL = int(os.getenv('PLATEGA_DNS_TTL', '300'))
+PLATEGA_KEEPALIVE = float(os.getenv('PLATEGA_KEEPALIVE', '60'))
+# Бюджеты времени на операцию, секунды (для проверки статуса - вместе с повторами)
+PLATEGA_CREATE_BUDGET = float(os.getenv('PLATEGA_CREATE_BUDGET', '15'))
+PLATEGA_STATUS_BUDGET = float(os.getenv('PLATEGA_STATUS_BUDGET', '10'))
+PLATEGA_STATUS_ATTEMPT_TIMEOUT = float(os.getenv('PLATEGA_STATUS_ATTEMPT_TIMEOUT', '4'))
+PLATEGA_STATUS_RETRIES = int(os.getenv('PLATEGA_STATUS_RETRIES', '2'))
+# Автомат защиты: размыкается при доле ошибок или медленных ответов выше порога
+PLATEGA_BREAKER_FAILURE_RATE = float(os.getenv('PLATEGA_BREAKER_FAILURE_RATE', '0.5'))
+PLATEGA_BREAKER_SLOW_CALL = float(os.getenv('PLATEGA_BREAKER_SLOW_CALL', '8'))
+PLATEGA_BREAKER_SLOW_RATE = float(os.getenv('PLATEGA_BREAKER_SLOW_RATE', '0.8'))
+PLATEGA_BREAKER_WINDOW = int(os.getenv('PLATEGA_BREAKER_WINDOW', '20'))
+PLATEGA_BREAKER_MIN_CALLS = int(os.getenv('PLATEGA_BREAKER_MIN_CALLS', '5'))
+PLATEGA_BREAKER_OPEN_SECONDS = float(os.getenv('PLATEGA_BREAKER_OPEN_SECONDS', '30'))
+
+# Финальные статусы Platega и соответствующие статусы в payments
+PLATEGA_STATUSES = {
+    'CONFIRMED': 'success',
+    'CANCELED': 'failed',
+}
+
+logger = logging.getLogger(__name__)
+# Полные ответы Platega: отдельный логгер, чтобы их можно было прореживать (LOG_SAMPLING)
+payload_logger = logging.getLogger('platega.payload')
+
+
+def parse_expires_in(value) -> Optional[int]:
+    """expiresIn Platega ("00:29:29") -> секунды; None, если формат неизвестен"""
+    try:
+        hours, minutes, seconds = (int(float(part)) for part in str(value).split(':'))
+    except (TypeError, ValueError):
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class PlategaAPI:
+    def __init__(self, base_url: str = PLATEGA_BASE_URL, conn_limit: int = PLATEGA_CONN_LIMIT):
+        self.api_key = PLATEGA_API_KEY
+        self.merchant_id = PLATEGA_MERCHANT_ID
+        self.base_url = base_url.rstrip('/')
+        self.conn_limit = conn_limit
+        self.headers = {
+            "X-MerchantId": self.merchant_id,
+            "X-Secret": self.api_key,
+            "Content-Type": "application/json"
+        }
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Время ответа по методам: {метод: {'count', 'total', 'max', 'last'}} в секундах
+        self.latency: dict = {}
+        self.breaker = CircuitBreaker(
+            "platega",
+            failure_rate=PLATEGA_BREAKER_FAILURE_RATE,
+            slow_call_seconds=PLATEGA_BREAKER_SLOW_CALL,
+            slow_call_rate=PLATEGA_BREAKER_SLOW_RATE,
+            window=PLATEGA_BREAKER_WINDOW,
+            min_calls=PLATEGA_BREAKER_MIN_CALLS,
+            open_seconds=PLATEGA_BREAKER_OPEN_SECONDS
+        )
+
+        if not self.api_key or not self.merchant_id:
+            logger.warning("⚠️ Ключи Platega не заданы полностью! Платежи не будут работать.")
+
+    async def start(self):
+        """Создает общую HTTP-сессию (вызывается при старте бота)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.conn_limit,
+                use_dns_cache=True,
+                ttl_dns_cache=PLATEGA_DNS_TTL,
+                keepalive_timeout=PLATEGA_KEEPALIVE
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def close(self):
+        """Закрывает HTTP-сессию (вызывается при остановке бота)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    def _record_latency(self, method: str, started: float) -> float:
+        elapsed = time.perf_counter() - started
+        stats = self.latency.setdefault(method, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['last'] = elapsed
+        logger.info(f"⏱ Platega {method}: {elapsed * 1000:.0f} мс")
+        PLATEGA_LATENCY.observe(elapsed, method)
+        profiler.record('platega', method, started)
+        return elapsed
+
+    async def create_payment(self, amount: int, order_id: str, description: str) -> Optional[dict]:
+        """Создает платеж в Platega и возвращает ответ (ссылка в 'redirect', ID в 'transactionId').
+
+        Если автомат защиты разомкнут, сразу бросает CircuitOpenError.
+        """
+        url = f"{self.base_url}/transaction/process"
+
+        data = {
+            "paymentMethod": 2,  # 2 = СБП QR
+            "paymentDetails": {
+                "amount": float(amount),
+                "currency": "RUB"
+            },
+            "description": description,
+            "return": f"{WEB_URL}/success",
+            "failedUrl": f"{WEB_URL}/fail",
+            "payload": order_id
+        }
+
+        # Создание счета не идемпотентно, поэтому без повторов: одна попытка в пределах бюджета
+        self.breaker.check()
+        started = time.perf_counter()
+        ok = False
+        try:
+            session = await self._get_session()
+            timeout = aiohttp.ClientTimeout(total=PLATEGA_CREATE_BUDGET)
+            async with session.post(url, json=data, timeout=timeout) as response:
+                result_text = await response.text()
+                payload_logger.info(f"Ответ от Platega (статус {response.status}): {result_text}")
+
+                if response.status == 200:
+                    result = json.loads(result_text)
+                    payment_url = result.get('redirect')
+                    if payment_url:
+                        logger.info(f"✅ Платеж создан. Ссылка: {payment_url}")
+                        ok = True
+                        return result
+                    else:
+                        logger.error(f"❌ Platega не вернул ссылку. Ответ: {result}")
+                else:
+                    logger.error(f"❌ Ошибка API Platega. Статус: {response.status}")
+                    logger.error(f"Тело ответа: {result_text}")
+        except aiohttp.ClientConnectorError as e:
+            logger.error(f"❌ Ошибка сети: {e}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания платежа: {e}")
+        finally:
+            self.breaker.record(ok, self._record_latency("create_payment", started))
+        return None
+
+    async def check_payment_status(self, transaction_id: str):
+        """Проверяет статус платежа в Platega по transactionId.
+
+        Запрос идемпотентный, поэтому сетевые ошибки и ответы 5xx повторяются
+        с джиттером, пока не исчерпан бюджет PLATEGA_STATUS_BUDGET.
+        """
+        url = f"{self.base_url}/transaction/{transaction_id}"
+        deadline = time.monotonic() + PLATEGA_STATUS_BUDGET
+
+        for attempt in range(PLATEGA_STATUS_RETRIES + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.breaker.check()
+            started = time.perf_counter()
+            ok, retryable = False, True
+            try:
+                session = await self._get_session()
+                timeout = aiohttp.ClientTimeout(total=min(PLATEGA_STATUS_ATTEMPT_TIMEOUT, remaining))
+                async with session.get(url, timeout=timeout) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        logger.info(f"Статус транзакции {transaction_id}: {result.get('status')}")
+                        ok = True
+                        return result
+                    else:
+                        logger.error(f"Ошибка при проверке статуса. Код: {response.status}")
+                        logger.error(await response.text())
+                        # 4xx повторять бесполезно, и это не сбой Platega
+                        retryable = response.status >= 500
+                        ok = not retryable
+            except Exception as e:
+                logger.error(f"Ошибка сети при проверке статуса: {e}")
+            finally:
+                self.breaker.record(ok, self._record_latency("check_payment_status", started))
+            if not retryable:
+                break
+            delay = retry_delay(attempt)
+            if attempt < PLATEGA_STATUS_RETRIES and time.monotonic() + delay < deadline:
+                logger.info(f"🔁 Повтор проверки статуса {transaction_id} через {delay * 1000:.0f} мс")
+                await asyncio.sleep(delay)
+        return None
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Локальный эмулятор Platega для нагрузочных тестов и проверки отказов
+
+Реализует /transaction/process и /transaction/{id} с теми же полями
+ответа, что у app.platega.io (transactionId, redirect, expiresIn,
+status), и через EMULATOR_CALLBACK_DELAY секунд отправляет callback на
+/platega-callback веб-сервера, повторяя доставку до ответа 200, как
+настоящая Platega. Отказы задаются долями: ошибки 500 и зависания API,
+задержка ответа с разбросом, дубли callback, устаревшие callback после
+финального статуса (out-of-order), потерянные callback.
+
+Бот и веб-сервер переключаются на эмулятор переменной окружения
+PLATEGA_BASE_URL=http://127.0.0.1:8099. Параметры отказов можно менять
+на лету: POST /emulator/config, счетчики - GET /emulator/stats.
+POST /emulator/callbacks {"orders": [...]} шлет callback для уже
+существующих заказов (например, засеянных в базу бенчмарком).
+
+Запуск: python platega_emulator.py [--port 8099] [--callback-url http://127.0.0.1:8000/platega-callback]
+        [--latency-ms 0] [--error-rate 0] [--duplicate-rate 0] [--out-of-order-rate 0] ...
+"""
+
+import os
+import argparse
+import asyncio
+import logging
+import random
+import time
+import uuid
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+# Конфигурация
+EMULATOR_HOST = os.getenv('EMULATOR_HOST', '127.0.0.1')
+EMULATOR_PORT = int(os.getenv('EMULATOR_PORT', '8099'))
+EMULATOR_CALLBACK_URL = os.getenv('EMULATOR_CALLBACK_URL', 'http://127.0.0.1:8000/platega-callback')
+EMULATOR_MERCHANT_ID = os.getenv('EMULATOR_MERCHANT_ID', '00000000-0000-0000-0000-000000000000')
+EMULATOR_CALLBACK_CONCURRENCY = int(os.getenv('EMULATOR_CALLBACK_CONCURRENCY', '100'))
+
+# Параметры по умолчанию; доли - от 0 до 1, время - в секундах
+DEFAULT_FAULTS = {
+    'latency': float(os.getenv('EMULATOR_LATENCY', '0')),
+    'latency_jitter': float(os.getenv('EMULATOR_LATENCY_JITTER', '0')),
+    'error_rate': float(os.getenv('EMULATOR_ERROR_RATE', '0')),         # ответ 500
+    'hang_rate': float(os.getenv('EMULATOR_HANG_RATE', '0')),           # ответ через hang_seconds
+    'hang_seconds': float(os.getenv('EMULATOR_HANG_SECONDS', '30')),
+    'callback_delay': float(os.getenv('EMULATOR_CALLBACK_DELAY', '1')),
+    'callback_jitter': float(os.getenv('EMULATOR_CALLBACK_JITTER', '0')),
+    'cancel_rate': float(os.getenv('EMULATOR_CANCEL_RATE', '0')),       # финальный статус CANCELED
+    'drop_rate': float(os.getenv('EMULATOR_DROP_RATE', '0')),           # callback не отправляется
+    'duplicate_rate': float(os.getenv('EMULATOR_DUPLICATE_RATE', '0')),
+    'duplicates': int(os.getenv('EMULATOR_DUPLICATES', '2')),           # лишних копий на дубль
+    'out_of_order_rate': float(os.getenv('EMULATOR_OUT_OF_ORDER_RATE', '0')),
+    'callback_retries': int(os.getenv('EMULATOR_CALLBACK_RETRIES', '5')),
+    'retry_delay': float(os.getenv('EMULATOR_RETRY_DELAY', '1')),
+}
+
+# Срок жизни ссылки, как в ответах Platega: "00:29:29"
+INVOICE_TTL = 29 * 60 + 29
+
+logger = logging.getLogger(__name__)
+
+
+def format_expires_in(seconds: float) -> str:
+    seconds = max(int(seconds), 0)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class PlategaEmulator:
+    def __init__(
+        self,
+        callback_url: Optional[str] = EMULATOR_CALLBACK_URL,
+        faults: Optional[dict] = None,
+        callback_concurrency: int = EMULATOR_CALLBACK_CONCURRENCY
+    ):
+        self.callback_url = callback_url
+        self.faults = {**DEFAULT_FAULTS, **(faults or {})}
+        self.callback_concurrency = callback_concurrency
+        # transactionId -> {'payload', 'amount', 'status', 'created'}
+        self.transactions: dict = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+        self.stats = {
+            'created': 0, 'status_checks': 0, 'errors_injected': 0, 'hangs_injected': 0,
+            'callbacks_sent': 0, 'callbacks_delivered': 0, 'callbacks_failed': 0, 'callbacks_retried': 0,
+            'callbacks_dropped': 0, 'duplicates_sent': 0, 'out_of_order_sent': 0,
+        }
+        # Время доставки callback (от отправки до ответа веб-сервера), секунды
+        self.callback_latency: list = []
+
+    # ===== HTTP-ПРИЛОЖЕНИЕ =====
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/transaction/process", self.process)
+        app.router.add_get("/transaction/{id}", self.status)
+        app.router.add_get("/emulator/stats", self.get_stats)
+        app.router.add_post("/emulator/config", self.set_config)
+        app.router.add_post("/emulator/callbacks", self.replay_callbacks)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app: web.Application):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.callback_concurrency),
+            headers={"X-MerchantId": EMULATOR_MERCHANT_ID}
+        )
+        self._semaphore = asyncio.Semaphore(self.callback_concurrency)
+
+    async def _on_cleanup(self, app: web.Application):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _chance(self, name: str) -> bool:
+        rate = self.faults[name]
+        return rate > 0 and random.random() < rate
+
+    async def _inject(self) -> Optional[web.Response]:
+        """Задержка ответа и сбои API; возвращает ответ-ошибку, если он выпал"""
+        if self._chance('hang_rate'):
+            self.stats['hangs_injected'] += 1
+            await asyncio.sleep(self.faults['hang_seconds'])
+        delay = self.faults['latency'] + random.uniform(0, self.faults['latency_jitter'])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._chance('error_rate'):
+            self.stats['errors_injected'] += 1
+            return web.json_response({"error": "Internal Server Error (emulated)"}, status=500)
+        return None
+
+    async def process(self, request: web.Request) -> web.Response:
+        """POST /transaction/process - создание платежа"""
+        data = await request.json()
+        error = await self._inject()
+        if error is not None:
+            return error
+
+        transaction_id = str(uuid.uuid4())
+        amount = float(data.get("paymentDetails", {}).get("amount", 0))
+        self.transactions[transaction_id] = {
+            'payload': data.get("payload"),
+            'amount': amount,
+            'status': 'PENDING',
+            'created': time.monotonic(),
+        }
+        self.stats['created'] += 1
+        self._schedule_callbacks(transaction_id)
+
+        return web.json_response({
+            "paymentMethod": "SBPQR",
+            "transactionId": transaction_id,
+            "redirect": f"https://pay.platega.io?id={transaction_id}&mh={EMULATOR_MERCHANT_ID}",
+            "return": data.get("return"),
+            "paymentDetails": f"{amount} RUB",
+            "status": "PENDING",
+            "expiresIn": format_expires_in(INVOICE_TTL),
+            "merchantId": EMULATOR_MERCHANT_ID,
+            "usdtRate": 84.5,
+            "cryptoAmount": 0,
+        })
+
+    async def status(self, request: web.Request) -> web.Response:
+        """GET /transaction/{id} - статус платежа"""
+        transaction_id = request.match_info["id"]
+        error = await self._inject()
+        if error is not None:
+            return error
+        self.stats['status_checks'] += 1
+        transaction = self.transactions.get(transaction_id)
+        if transaction is None:
+            return web.json_response({"error": "Transaction not found"}, status=404)
+        expires_in = INVOICE_TTL - (time.monotonic() - transaction['created'])
+        return web.json_response({
+            "id": transaction_id,
+            "status": transaction['status'],
+            "paymentDetails": {"amount": transaction['amount'], "currency": "RUB"},
+            "payload": transaction['payload'],
+            "expiresIn": format_expires_in(expires_in),
+        })
+
+    # ===== CALLBACK =====
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _schedule_callbacks(self, transaction_id: str, delay: Optional[float] = None):
+        """Планирует финальный callback и, по выпавшим долям, дубли и устаревший callback"""
+        if not self.callback_url:
+            return
+        if self._chance('drop_rate'):
+            self.stats['callbacks_dropped'] += 1
+            return
+        final = 'CANCELED' if self._chance('cancel_rate') else 'CONFIRMED'
+        if delay is None:
+            delay = self.faults['callback_delay'] + random.uniform(0, self.faults['callback_jitter'])
+        self._spawn(self._deliver(transaction_id, final, delay, set_status=True))
+
+        if self._chance('duplicate_rate'):
+            for _ in range(self.faults['duplicates']):
+                self.stats['duplicates_sent'] += 1
+                # Часть копий одновременно с оригиналом, часть позже
+                self._spawn(self._deliver(transaction_id, final, delay + random.uniform(0, 0.5)))
+        if self._chance('out_of_order_rate'):
+            # Противоположный статус после финального: веб-сервер должен его проигнорировать
+            stale = 'CANCELED' if final == 'CONFIRMED' else 'CONFIRMED'
+            self.stats['out_of_order_sent'] += 1
+            self._spawn(self._deliver(transaction_id, stale, delay + random.uniform(0.01, 0.5)))
+
+    async def _deliver(self, transaction_id: str, status: str, delay: float, set_status: bool = False):
+        await asyncio.sleep(delay)
+        transaction = self.transactions[transaction_id]
+        if set_status:
+            transaction['status'] = status
+        body = {
+            "id": transaction_id,
+            "amount": transaction['amount'],
+            "currency": "RUB",
+            "status": status,
+            "paymentMethod": 2,
+            "payload": transaction['payload'],
+        }
+        for attempt in range(self.faults['callback_retries'] + 1):
+            if attempt:
+                self.stats['callbacks_retried'] += 1
+                await asyncio.sleep(self.faults['retry_delay'] * 2 ** (attempt - 1))
+            self.stats['callbacks_sent'] += 1
+            started = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    async with self._session.post(self.callback_url, json=body) as response:
+                        await response.read()
+                        ok = response.status == 200
+            except aiohttp.ClientError as e:
+                logger.debug(f"Callback {transaction_id} не доставлен: {e}")
+                ok = False
+            if ok:
+                self.stats['callbacks_delivered'] += 1
+                self.callback_latency.append(time.perf_counter() - started)
+                return
+        self.stats['callbacks_failed'] += 1
+        logger.warning(f"⚠️ Callback {transaction_id} ({status}) не доставлен после {attempt + 1} попыток")
+
+    # ===== УПРАВЛЕНИЕ =====
+    async def get_stats(self, request: web.Request) -> web.Response:
+        latency = sorted(self.callback_latency)
+        summary = {}
+        if latency:
+            summary = {
+                'p50_ms': round(latency[len(latency) // 2] * 1000, 2),
+                'p99_ms': round(latency[min(int(len(latency) * 0.99), len(latency) - 1)] * 1000, 2),
+            }
+        return web.json_response({
+            **self.stats,
+            'pending_deliveries': len(self._tasks),
+            'callback_latency': summary,
+            'faults': self.faults,
+        })
+
+    async def set_config(self, request: web.Request) -> web.Response:
+        """Меняет параметры отказов: {"error_rate": 0.2, "latency": 0.5, ...}"""
+        changes = await request.json()
+        unknown = set(changes) - set(self.faults)
+        if unknown:
+            return web.json_response({"error": f"Неизвестные параметры: {sorted(unknown)}"}, status=400)
+        for name, value in changes.items():
+            self.faults[name] = type(DEFAULT_FAULTS[name])(value)
+        logger.info(f"⚙️ Параметры эмулятора: {changes}")
+        return web.json_response(self.faults)
+
+    async def replay_callbacks(self, request: web.Request) -> web.Response:
+        """Callback для заказов, созданных не через эмулятор: {"orders": [...], "delay": 0}"""
+        data = await request.json()
+        delay = data.get("delay")
+        for order_id in data.get("orders", []):
+            transaction_id = str(uuid.uuid4())
+            self.transactions[transaction_id] = {
+                'payload': order_id, 'amount': float(data.get("amount", 0)),
+                'status': 'PENDING', 'created': time.monotonic(),
+            }
+            self._schedule_callbacks(transaction_id, delay)
+        return web.json_response({"scheduled": len(data.get("orders", []))})
+
+
+async def start_emulator(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    callback_url: Optional[str] = EMULATOR_CALLBACK_URL,
+    **faults
+) -> tuple:
+    """Запускает эмулятор в текущем event loop и возвращает (runner, emulator, base_url)"""
+    emulator = PlategaEmulator(callback_url, faults)
+    runner = web.AppRunner(emulator.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, emulator, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=EMULATOR_HOST)
+    parser.add_argument("--port", type=int, default=EMULATOR_PORT)
+    parser.add_argument("--callback-url", default=EMULATOR_CALLBACK_URL, help="пустая строка - без callback")
+    for name, default in DEFAULT_FAULTS.items():
+        option = "--" + name.replace('_', '-')
+        if name in ('latency', 'latency_jitter', 'callback_delay', 'callback_jitter'):
+            # Задержки в командной строке - в миллисекундах
+            parser.add_argument(option + "-ms", dest=name, type=float, default=default * 1000)
+        else:
+            parser.add_argument(option, dest=name, type=type(default), default=default)
+    args = parser.parse_args()
+
+    faults = {name: getattr(args, name) for name in DEFAULT_FAULTS}
+    for name in ('latency', 'latency_jitter', 'callback_delay', 'callback_jitter'):
+        faults[name] /= 1000
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    emulator = PlategaEmulator(args.callback_url or None, faults)
+    logger.info(f"🧪 Эмулятор Platega: http://{args.host}:{args.port}, callback -> {args.callback_url or 'выключены'}")
+    logger.info(f"Для бота и веб-сервера: PLATEGA_BASE_URL=http://{args.host}:{args.port}")
+    web.run_app(emulator.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Профилировщик медленных апдейтов (включается PROFILE_UPDATES=1)
+
+Каждый await-сегмент обработки (запрос к БД, вызов Platega, вызов
+Telegram API) записывается в трассу текущей задачи. Если апдейт
+обрабатывался дольше PROFILE_THRESHOLD_MS, трасса пишется одной
+JSON-строкой в PROFILE_FILE (с ротацией). С PROFILE_STACKS=1 отдельный
+поток сэмплирует стек event loop, и к трассе прикладываются самые
+частые стеки за время обработки - видно, что блокировало цикл.
+Без профилировщика запись сегмента - одна проверка contextvar.
+"""
+
+import os
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from logging_setup import CompressingRotatingFileHandler
+
+# Конфигурация
+PROFILE_UPDATES = os.getenv('PROFILE_UPDATES', '0') == '1'
+PROFILE_THRESHOLD_MS = float(os.getenv('PROFILE_THRESHOLD_MS', '1000'))
+PROFILE_FILE = os.getenv('PROFILE_FILE', 'slow_updates.log')
+PROFILE_STACKS = os.getenv('PROFILE_STACKS', '0') == '1'
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_TOP_STACKS = 10
+
+logger = logging.getLogger(__name__)
+
+_trace: contextvars.ContextVar = contextvars.ContextVar('profile_trace', default=None)
+
+
+class Trace:
+    """Сегменты одной единицы работы: (вид, имя, начало от старта трассы, длительность), секунды"""
+
+    __slots__ = ('name', 'fields', 'started', 'segments')
+
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.segments: list = []
+
+
+def record(kind: str, name: str, started: float):
+    """Добавляет в текущую трассу сегмент, начавшийся в started (time.perf_counter())"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.segments.append((kind, name, started - trace.started, time.perf_counter() - started))
+
+
+class StackSampler(threading.Thread):
+    """Периодически снимает стек потока event loop в кольцевой буфер"""
+
+    def __init__(self, thread_id: int, interval: float, maxlen: int = 20000):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = deque(maxlen=maxlen)
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), ';'.join(reversed(stack))))
+
+    def top(self, started: float, finished: float, limit: int = PROFILE_TOP_STACKS) -> list:
+        counts = Counter(stack for ts, stack in list(self.samples) if started <= ts <= finished)
+        return [{'stack': stack, 'samples': count} for stack, count in counts.most_common(limit)]
+
+    def stop(self):
+        self._stopped.set()
+
+
+class SlowUpdateProfiler:
+    def __init__(
+        self,
+        threshold_ms: float = PROFILE_THRESHOLD_MS,
+        path: str = PROFILE_FILE,
+        stacks: bool = PROFILE_STACKS
+    ):
+        self.threshold = threshold_ms / 1000
+        self.path = path
+        self.stacks = stacks
+        self._sampler: Optional[StackSampler] = None
+        self._listener = None
+        self._out: Optional[logging.Logger] = None
+        self.stats = {'traced': 0, 'slow': 0}
+
+    def start(self):
+        """Открывает файл трасс (запись в отдельном потоке) и, если нужно, запускает сэмплер"""
+        if self._out is not None:
+            return
+        handler = CompressingRotatingFileHandler(self.path, 10 * 1024 * 1024, 0, 5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log_queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(log_queue, handler)
+        self._listener.start()
+        self._out = logging.Logger('profiler.traces')
+        self._out.addHandler(logging.handlers.QueueHandler(log_queue))
+        if self.stacks:
+            self._sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+            self._sampler.start()
+        logger.info(f"🔬 Профилировщик апдейтов включен: порог {self.threshold * 1000:.0f} мс, файл {self.path}")
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._out = None
+
+    @asynccontextmanager
+    async def trace(self, name: str, **fields):
+        """Трассирует блок как отдельную единицу работы (апдейт или фоновую задачу)"""
+        if self._out is None:
+            yield
+            return
+        trace = Trace(name, fields)
+        token = _trace.set(trace)
+        try:
+            yield
+        finally:
+            _trace.reset(token)
+            self._finish(trace)
+
+    def _finish(self, trace: Trace):
+        finished = time.perf_counter()
+        total = finished - trace.started
+        self.stats['traced'] += 1
+        if total < self.threshold:
+            return
+        self.stats['slow'] += 1
+        awaited = sum(duration for _, _, _, duration in trace.segments)
+        entry = {
+            'ts': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'name': trace.name,
+            **trace.fields,
+            'total_ms': round(total * 1000, 1),
+            # Время вне записанных сегментов: собственный код, ожидание цикла, незамеренные await
+            'other_ms': round(max(total - awaited, 0) * 1000, 1),
+            'segments': [
+                {'kind': kind, 'name': name, 'at_ms': round(offset * 1000, 1), 'ms': round(duration * 1000, 1)}
+                for kind, name, offset, duration in trace.segments
+            ],
+        }
+        if self._sampler is not None:
+            entry['stacks'] = self._sampler.top(trace.started, finished)
+        self._out.info(json.dumps(entry, ensure_ascii=False, default=str))
+        logger.warning(f"🐢 Медленно: {trace.name} {total * 1000:.0f} мс, разбор в {self.path}")
+
+    async def run(self, name: str, coro, **fields):
+        """Выполняет корутину фоновой задачи под отдельной трассой"""
+        async with self.trace(name, **fields):
+            return await coro
+
+    async def update_middleware(self, handler, event, data: dict):
+        """Внешний middleware Dispatcher.update"""
+        user = data.get('event_from_user')
+        async with self.trace(f"update:{event.event_type}", update_id=event.update_id, user_id=user.id if user else None):
+            return await handler(event, data)
+
+    async def request_middleware(self, make_request, bot, method):
+        """Middleware сессии бота: время каждого вызова Telegram API"""
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            record('telegram', type(method).__name__, started)
+
+
+profiler = SlowUpdateProfiler()
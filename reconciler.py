@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Фоновая сверка pending-платежей с Platega
+
+Если callback от Platega потерялся, платеж навсегда остается в статусе
+pending. Сверка периодически опрашивает Platega по сохраненному ID
+транзакции: часто сразу после создания счета, затем все реже до конца
+окна expiresIn (~30 мин), после чего опрос прекращается.
+"""
+
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+
+from database import Database, transition_payment
+from metrics import PAYMENT_TRANSITIONS
+from outbox import notify
+from platega import PlategaAPI, PLATEGA_STATUSES
+from resilience import CircuitOpenError
+from timeutil import format_timestamp, parse_timestamp
+
+# Конфигурация
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '5'))
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', '5'))
+# Окно опроса: expiresIn Platega (~30 мин) с запасом
+RECONCILE_WINDOW = int(os.getenv('RECONCILE_WINDOW', '2100'))
+
+# (возраст платежа до N секунд, интервал опроса в секундах)
+POLL_SCHEDULE = [
+    (120, 10),
+    (600, 30),
+    (1800, 120),
+]
+POLL_INTERVAL_MAX = 300
+
+logger = logging.getLogger(__name__)
+
+
+def poll_interval(age: float) -> float:
+    """Интервал до следующего опроса платежа указанного возраста"""
+    for max_age, interval in POLL_SCHEDULE:
+        if age < max_age:
+            return interval
+    return POLL_INTERVAL_MAX
+
+
+class PaymentReconciler:
+    def __init__(
+        self,
+        db: Database,
+        platega: PlategaAPI,
+        interval: float = RECONCILE_INTERVAL,
+        concurrency: int = RECONCILE_CONCURRENCY,
+        window: int = RECONCILE_WINDOW
+    ):
+        self.db = db
+        self.platega = platega
+        self.interval = interval
+        self.window = window
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_check: dict = {}
+        self._task = None
+        self.stats = {'checked': 0, 'fixed': 0, 'confirmed': 0, 'canceled': 0, 'errors': 0}
+        # Время от создания платежа до подтверждения сверкой, секунды
+        self.confirm_latency = deque(maxlen=1000)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+            logger.info("🔁 Сверка платежей с Platega запущена")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка сверки платежей: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _fetch_pending(self) -> list:
+        cutoff = format_timestamp(time.time() - self.window)
+        return await self.db.fetchall('''
+            SELECT order_id, platega_order_id, created_at
+            FROM payments
+            WHERE status = 'pending' AND platega_order_id IS NOT NULL AND created_at >= ?
+        ''', (cutoff,))
+
+    async def _check(self, row) -> tuple:
+        async with self._semaphore:
+            try:
+                result = await self.platega.check_payment_status(row['platega_order_id'])
+            except CircuitOpenError:
+                result = None
+        return row, result
+
+    @staticmethod
+    def _apply(conn, updates: list) -> list:
+        """Записывает финальные статусы одной транзакцией; возвращает примененные"""
+        applied = []
+        for row, status in updates:
+            result, _ = transition_payment(conn, row['order_id'], status)
+            if result == 'applied':
+                applied.append((row['order_id'], status, row['created_at']))
+        return applied
+
+    async def run_once(self) -> int:
+        """Один проход сверки; возвращает число исправленных платежей"""
+        if not self.platega.breaker.allows_requests():
+            # Platega недоступна: не копим запросы, дождемся восстановления
+            return 0
+        now = time.time()
+        pending = await self._fetch_pending()
+
+        # Забываем расписание платежей, которые вышли из окна или уже не pending
+        known = {row['order_id'] for row in pending}
+        for order_id in list(self._next_check):
+            if order_id not in known:
+                del self._next_check[order_id]
+
+        due = [row for row in pending if self._next_check.get(row['order_id'], 0) <= now]
+        if not due:
+            return 0
+
+        results = await asyncio.gather(*(self._check(row) for row in due))
+
+        updates = []
+        for row, result in results:
+            self.stats['checked'] += 1
+            if result is None:
+                self.stats['errors'] += 1
+            status = PLATEGA_STATUSES.get((result or {}).get('status'))
+            if status:
+                updates.append((row, status))
+            else:
+                age = now - parse_timestamp(row['created_at'])
+                self._next_check[row['order_id']] = now + poll_interval(age)
+
+        if not updates:
+            return 0
+
+        applied = await self.db.run(self._apply, updates)
+        if applied:
+            notify()
+        finished = time.time()
+        for order_id, status, created_at in applied:
+            self._next_check.pop(order_id, None)
+            PAYMENT_TRANSITIONS.inc(status, 'reconciler')
+            self.stats['fixed'] += 1
+            if status == 'success':
+                self.stats['confirmed'] += 1
+                self.confirm_latency.append(finished - parse_timestamp(created_at))
+            else:
+                self.stats['canceled'] += 1
+
+        if applied:
+            latency = self.latency_summary()
+            logger.info(
+                f"🔁 Сверка: исправлено {len(applied)} платежей "
+                f"(всего {self.stats['fixed']}, подтверждено {self.stats['confirmed']}, отменено {self.stats['canceled']}); "
+                f"задержка подтверждения: среднее {latency['avg']:.0f} с, макс {latency['max']:.0f} с"
+            )
+        return len(applied)
+
+    def latency_summary(self) -> dict:
+        """Сквозная задержка подтверждения (создание счета -> запись статуса), секунды"""
+        if not self.confirm_latency:
+            return {'avg': 0.0, 'max': 0.0}
+        return {
+            'avg': sum(self.confirm_latency) / len(self.confirm_latency),
+            'max': max(self.confirm_latency),
+        }
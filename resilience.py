@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Устойчивость вызовов внешних API: автомат защиты и повторы с джиттером
+
+Когда Platega тормозит или недоступна, каждый вызов ждет таймаут целиком
+и держит строки БД и сообщения Telegram. Автомат защиты (circuit breaker)
+считает долю ошибок и медленных ответов в скользящем окне и при
+превышении порога на время отказывает сразу, не обращаясь к API.
+"""
+
+import logging
+import random
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Автомат разомкнут: вызов отклонен без обращения к API"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} временно недоступен, повтор через {retry_after:.0f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автомат защиты по доле ошибок и медленных вызовов в окне последних window вызовов"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        slow_call_rate: float = 0.5,
+        window: int = 20,
+        min_calls: int = 5,
+        open_seconds: float = 30.0
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        # (ошибка, медленный) по последним вызовам
+        self._calls = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.stats = {'state': CLOSED, 'opened': 0, 'rejected': 0, 'failures': 0, 'slow': 0}
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning(f"⚡ Автомат {self.name}: {self._state} -> {state}")
+        self._state = state
+        self.stats['state'] = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self.stats['opened'] += 1
+        elif state == CLOSED:
+            self._calls.clear()
+        self._probe_in_flight = False
+
+    def allows_requests(self) -> bool:
+        """Можно ли сейчас обращаться к API (без учета пробного вызова)"""
+        return self.state != OPEN
+
+    def ensure_available(self):
+        """Бросает CircuitOpenError, если автомат разомкнут (пробный вызов не расходуется)"""
+        if self.state == OPEN:
+            self.stats['rejected'] += 1
+            raise CircuitOpenError(self.name, self._retry_after())
+
+    def _retry_after(self) -> float:
+        return max(self.open_seconds - (time.monotonic() - self._opened_at), 0.0)
+
+    def check(self):
+        """Разрешает вызов или бросает CircuitOpenError; в half_open пропускает один пробный вызов"""
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        self.stats['rejected'] += 1
+        raise CircuitOpenError(self.name, self._retry_after())
+
+    def record(self, success: bool, elapsed: float):
+        """Учитывает результат вызова, разрешенного check()"""
+        slow = elapsed >= self.slow_call_seconds
+        self.stats['failures'] += not success
+        self.stats['slow'] += slow
+        if self._state == HALF_OPEN:
+            self._transition(CLOSED if success and not slow else OPEN)
+            return
+        self._calls.append((not success, slow))
+        if self._state == CLOSED and len(self._calls) >= self.min_calls:
+            failures = sum(failed for failed, _ in self._calls) / len(self._calls)
+            slow_calls = sum(slow for _, slow in self._calls) / len(self._calls)
+            if failures >= self.failure_rate or slow_calls >= self.slow_call_rate:
+                logger.error(
+                    f"⚡ Автомат {self.name} разомкнут: ошибок {failures:.0%}, медленных {slow_calls:.0%} "
+                    f"из {len(self._calls)} последних вызовов"
+                )
+                self._transition(OPEN)
+
+
+def retry_delay(attempt: int, base: float = 0.2, cap: float = 2.0) -> float:
+    """Пауза перед повтором attempt (с 0): экспонента с полным джиттером"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
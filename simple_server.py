@@ -11,6 +11,10 @@ import sqlite3
 import logging
 from urllib.parse import urlparse
 
+from database import DB_PATH, connect, transition_payment
+from outbox import notify as notify_outbox
+from platega import PLATEGA_STATUSES
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -41,20 +45,25 @@ class PlategaHandler(http.server.BaseHTTPRequestHandler):
                 status = data.get("status")     # "CONFIRMED" или "CANCELED"
                 platega_tx_id = data.get("id")  # Это ID транзакции Platega
                 
-                if order_id and status:
-                    # Обновляем базу данных
-                    conn = sqlite3.connect('vpn.db')
-                    cursor = conn.cursor()
-                    
-                    new_status = "success" if status == "CONFIRMED" else "failed"
-                    cursor.execute(
-                        "UPDATE payments SET status = ?, platega_order_id = ? WHERE order_id = ?",
-                        (new_status, platega_tx_id, order_id)
-                    )
-                    conn.commit()
-                    conn.close()
+                new_status = PLATEGA_STATUSES.get(status)
+                if order_id and new_status is None:
+                    # Промежуточный статус (например, PENDING): ждем финального callback
+                    logger.info(f"ℹ️ Платеж {order_id}: статус '{status}' не финальный, пропускаем")
+                elif order_id:
+                    # Тот же переход, что у web_server: только из pending и с событием outbox для бота
+                    conn = connect(DB_PATH)
+                    try:
+                        with conn:
+                            result, _ = transition_payment(conn, order_id, new_status, platega_tx_id)
+                    finally:
+                        conn.close()
                     
-                    logger.info(f"✅ Обновлен статус {order_id}: {new_status} (Platega ID: {platega_tx_id})")
+                    if result == "applied":
+                        if new_status == "success":
+                            notify_outbox()
+                        logger.info(f"✅ Обновлен статус {order_id}: {new_status} (Platega ID: {platega_tx_id})")
+                    else:
+                        logger.info(f"ℹ️ Платеж {order_id}: callback '{status}' пропущен ({result})")
                 
                 self.send_response(200)
                 self.send_header('Content-type', 'application/json')
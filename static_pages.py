@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Предварительно отрисованные страницы и сжатые статические файлы
+
+Страницы сайта (index, privacy, terms) зависят только от настроек,
+поэтому отрисовываются один раз и хранятся вместе с gzip/brotli-версиями.
+Повторная отрисовка происходит только при изменении mtime шаблонов.
+Статические файлы получают адрес с хэшем содержимого и отдаются с
+долгим immutable-кэшированием.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаем gzip
+    brotli = None
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+PAGE_CACHE = "public, no-cache"
+# Как часто проверять mtime шаблонов и файлов, секунды
+CHECK_INTERVAL = 1.0
+# Не сжимаем совсем маленькие ответы
+MIN_COMPRESS_SIZE = 512
+
+
+def accepted_encodings(request: Request) -> set:
+    """Кодировки из Accept-Encoding, кроме явно запрещенных (q=0)"""
+    result = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if name:
+            result.add(name.strip().lower())
+    return result
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Проверка заголовка If-None-Match (список тегов, слабые теги W/, *)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class Variants:
+    """Тело ответа в исходном и сжатых видах"""
+
+    def __init__(self, body: bytes, media_type: str):
+        self.media_type = media_type
+        self.digest = hashlib.sha1(body).hexdigest()[:20]
+        self.bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            self.bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding: str) -> str:
+        """Байты разных кодировок различаются, поэтому и теги у них свои"""
+        suffix = {"gzip": "-gz", "br": "-br"}.get(encoding, "")
+        return f'"{self.digest}{suffix}"'
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        accepted = accepted_encodings(request)
+        encoding = next((e for e in ("br", "gzip") if e in self.bodies and e in accepted), "identity")
+        headers = {"ETag": self.etag(encoding), "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.bodies[encoding], media_type=self.media_type, headers=headers)
+
+
+class StaticAssets:
+    """Статические файлы с хэшем содержимого в имени (style.css -> style.<hash>.css)"""
+
+    def __init__(self, directory: str, url_prefix: str = "/assets", fallback_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.fallback_prefix = fallback_prefix
+        self._urls: dict = {}
+        self._files: dict = {}
+        self._mtimes: dict = {}
+        self.scan()
+
+    def _walk(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full = os.path.join(root, name)
+                yield os.path.relpath(full, self.directory).replace(os.sep, "/"), full
+
+    def scan(self) -> bool:
+        """Перечитывает изменившиеся файлы; возвращает True, если что-то изменилось"""
+        changed = False
+        seen = set()
+        for path, full in self._walk():
+            seen.add(path)
+            mtime = os.stat(full).st_mtime
+            if self._mtimes.get(path) == mtime:
+                continue
+            with open(full, "rb") as f:
+                body = f.read()
+            digest = hashlib.sha256(body).hexdigest()[:10]
+            base, ext = os.path.splitext(path)
+            hashed = f"{base}.{digest}{ext}"
+            old = self._urls.get(path)
+            if old:
+                self._files.pop(old[len(self.url_prefix) + 1:], None)
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            self._files[hashed] = Variants(body, media_type)
+            self._urls[path] = f"{self.url_prefix}/{hashed}"
+            self._mtimes[path] = mtime
+            changed = True
+        for path in set(self._urls) - seen:
+            self._files.pop(self._urls.pop(path)[len(self.url_prefix) + 1:], None)
+            self._mtimes.pop(path, None)
+            changed = True
+        return changed
+
+    def url(self, path: str) -> str:
+        """Адрес файла с хэшем; для неизвестных файлов - обычный /static/..."""
+        return self._urls.get(path.lstrip("/"), f"{self.fallback_prefix}/{path.lstrip('/')}")
+
+    def response(self, request: Request, hashed_path: str) -> Optional[Response]:
+        variants = self._files.get(hashed_path)
+        if variants is None:
+            return None
+        return variants.response(request, IMMUTABLE_CACHE)
+
+
+class PrerenderedPages:
+    """Страницы, отрисованные один раз по шаблону и фиксированному контексту"""
+
+    def __init__(self, env, assets: StaticAssets, context: dict):
+        self.env = env
+        self.assets = assets
+        self.context = context
+        self._pages: dict = {}
+        self._signature = None
+        self._checked_at = 0.0
+        env.globals["static_url"] = assets.url
+
+    def _templates_signature(self) -> tuple:
+        searchpath = getattr(self.env.loader, "searchpath", [])
+        mtimes = []
+        for directory in searchpath:
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".html"):
+                    mtimes.append((name, os.stat(os.path.join(directory, name)).st_mtime))
+        return tuple(mtimes)
+
+    def _check(self):
+        now = time.monotonic()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        assets_changed = self.assets.scan()
+        signature = self._templates_signature()
+        if assets_changed or signature != self._signature:
+            # Шаблон или файл изменился: страницы будут отрисованы заново
+            self._pages.clear()
+            self._signature = signature
+
+    def render(self, name: str) -> Variants:
+        variants = self._pages.get(name)
+        if variants is None:
+            body = self.env.get_template(name).render(**self.context).encode("utf-8")
+            variants = Variants(body, "text/html; charset=utf-8")
+            self._pages[name] = variants
+        return variants
+
+    def warm(self, names: list):
+        """Отрисовывает страницы заранее (при старте сервера)"""
+        self._check()
+        for name in names:
+            self.render(name)
+
+    def response(self, request: Request, name: str) -> Response:
+        self._check()
+        return self.render(name).response(request, PAGE_CACHE)
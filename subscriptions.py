@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Планировщик истечения подписок
+
+Срок подписки хранится в users.expires_at и продлевается триггером при
+каждой успешной оплате. Планировщик держит в куче ближайшие события
+(истечение и напоминание за SUBSCRIPTION_REMIND_DAYS дней) для
+SUBSCRIPTION_WINDOW ближайших подписок, загруженных по частичному индексу,
+и спит ровно до первого из них. Проснувшись, он выключает истекшие
+подписки и отмечает напомненные пачками по индексу - без обхода
+таблицы. Записи в куче могут устареть (подписку продлили): решение
+принимает условный UPDATE в базе, поэтому лишнее пробуждение безвредно.
+"""
+
+import os
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from database import UsersRepository
+from throttling import TokenBuckets
+from timeutil import format_timestamp, parse_timestamp
+
+# Конфигурация
+SUBSCRIPTION_REMIND_DAYS = float(os.getenv('SUBSCRIPTION_REMIND_DAYS', '3'))
+SUBSCRIPTION_BATCH = int(os.getenv('SUBSCRIPTION_BATCH', '500'))
+SUBSCRIPTION_WINDOW = int(os.getenv('SUBSCRIPTION_WINDOW', '1000'))
+SUBSCRIPTION_NOTIFY_RATE = float(os.getenv('SUBSCRIPTION_NOTIFY_RATE', '20'))
+# Страховочная перезагрузка кучи: изменения сроков, о которых планировщику не сообщили
+SUBSCRIPTION_MAX_SLEEP = float(os.getenv('SUBSCRIPTION_MAX_SLEEP', '3600'))
+
+EXPIRED = "expired"
+REMIND = "remind"
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionScheduler:
+    def __init__(
+        self,
+        users: UsersRepository,
+        notify: Callable[[str, int, float], Awaitable[None]],
+        remind_days: float = SUBSCRIPTION_REMIND_DAYS,
+        batch: int = SUBSCRIPTION_BATCH,
+        window: int = SUBSCRIPTION_WINDOW,
+        notify_rate: float = SUBSCRIPTION_NOTIFY_RATE
+    ):
+        self.users = users
+        # notify(событие, telegram_id, срок подписки unix time)
+        self.notify = notify
+        self.remind_ahead = remind_days * 86400
+        self.batch = batch
+        self.window = window
+        self.buckets = TokenBuckets({'default': (notify_rate, 1)})
+        # (время события, событие, telegram_id)
+        self._heap: list = []
+        # Сроки позже horizon в кучу не загружены
+        self._horizon = float('inf')
+        self._loaded_at = 0.0
+        self._wake = asyncio.Event()
+        self._task = None
+        self.stats = {'expired': 0, 'reminded': 0, 'wakeups': 0, 'reloads': 0}
+
+    async def start(self):
+        if self._task is None:
+            try:
+                await self._load()
+            except Exception as e:
+                # Не мешаем запуску бота: цикл перечитает индекс сам
+                logger.error(f"❌ Планировщик подписок не загрузил сроки: {e}")
+                self._loaded_at = float('-inf')
+            self._task = asyncio.create_task(self._loop())
+            logger.info(f"⏳ Планировщик подписок: {len(self._heap)} событий, ближайшее через {self._next_in():.0f} с")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def add(self, telegram_id: int):
+        """Срок подписки изменился (оплата): добавляет события пользователя, если они раньше загруженных"""
+        row = await self.users.get_subscription(telegram_id)
+        if not row or not row['is_active'] or not row['expires_at']:
+            return
+        expires = parse_timestamp(row['expires_at'])
+        if expires <= self._horizon:
+            self._push(telegram_id, expires, reminded=False)
+            self._wake.set()
+
+    # ===== КУЧА =====
+    def _push(self, telegram_id: int, expires: float, reminded: bool):
+        heapq.heappush(self._heap, (expires, EXPIRED, telegram_id))
+        if not reminded:
+            heapq.heappush(self._heap, (expires - self.remind_ahead, REMIND, telegram_id))
+
+    async def _load(self):
+        """Ближайшие window подписок из индекса"""
+        rows = await self.users.next_expiries(self.window)
+        self._heap = []
+        for row in rows:
+            self._push(row['telegram_id'], parse_timestamp(row['expires_at']), bool(row['reminded']))
+        self._horizon = parse_timestamp(rows[-1]['expires_at']) if len(rows) >= self.window else float('inf')
+        self._loaded_at = time.monotonic()
+        self.stats['reloads'] += 1
+
+    def _next_in(self) -> float:
+        return max(self._heap[0][0] - time.time(), 0) if self._heap else SUBSCRIPTION_MAX_SLEEP
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._run_due()
+                # Куча опустела (остальное за горизонтом) или пора страховочно перечитать индекс
+                if (not self._heap and self._horizon != float('inf')) \
+                        or time.monotonic() - self._loaded_at >= SUBSCRIPTION_MAX_SLEEP:
+                    await self._load()
+            except Exception as e:
+                logger.error(f"❌ Ошибка планировщика подписок: {e}")
+                await asyncio.sleep(5)
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), min(self._next_in(), SUBSCRIPTION_MAX_SLEEP))
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _run_due(self):
+        now = time.time()
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            due.add(heapq.heappop(self._heap)[1])
+        if not due:
+            return
+        self.stats['wakeups'] += 1
+        if EXPIRED in due:
+            await self._expire(now)
+        if REMIND in due:
+            await self._remind(now)
+
+    # ===== ДЕЙСТВИЯ =====
+    async def _expire(self, now: float):
+        while True:
+            rows = await self.users.deactivate_expired(format_timestamp(now), self.batch)
+            if rows:
+                self.stats['expired'] += len(rows)
+                logger.info(f"⌛ Подписки истекли: {len(rows)}")
+                await self._notify_all(EXPIRED, rows)
+            if len(rows) < self.batch:
+                return
+
+    async def _remind(self, now: float):
+        while True:
+            rows = await self.users.claim_reminders(format_timestamp(now + self.remind_ahead), self.batch)
+            if rows:
+                self.stats['reminded'] += len(rows)
+                logger.info(f"🔔 Напоминания о продлении: {len(rows)}")
+                await self._notify_all(REMIND, rows)
+            if len(rows) < self.batch:
+                return
+
+    async def _notify_all(self, event: str, rows: list):
+        """Сообщения пользователям с ограничением скорости; отметка в базе уже стоит (не чаще одного раза)"""
+        for row in rows:
+            while True:
+                wait = self.buckets.take(0, event)
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            try:
+                await self.notify(event, row['telegram_id'], parse_timestamp(row['expires_at']))
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                try:
+                    await self.notify(event, row['telegram_id'], parse_timestamp(row['expires_at']))
+                except Exception as e:
+                    logger.warning(f"⚠️ Уведомление {event} для {row['telegram_id']} не отправлено: {e}")
+            except TelegramForbiddenError:
+                pass
+            except Exception as e:
+                logger.warning(f"⚠️ Уведомление {event} для {row['telegram_id']} не отправлено: {e}")
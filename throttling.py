@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Ограничение частоты действий пользователя (token bucket) для aiogram
+
+У каждого пользователя своя корзина токенов на каждый тип действия.
+Дорогие действия (создание счета, проверка статуса) получают отдельные,
+более строгие квоты. Корзины, которые долго не использовались, удаляются:
+к этому моменту они все равно снова полные.
+"""
+
+import os
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+# Конфигурация
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '1'))
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', '5'))
+THROTTLE_INVOICE_INTERVAL = float(os.getenv('THROTTLE_INVOICE_INTERVAL', '20'))
+THROTTLE_INVOICE_BURST = int(os.getenv('THROTTLE_INVOICE_BURST', '3'))
+THROTTLE_IDLE_TTL = float(os.getenv('THROTTLE_IDLE_TTL', '600'))
+
+# Квоты по типам действий: (токенов в секунду, емкость корзины)
+THROTTLE_LIMITS = {
+    'default': (THROTTLE_RATE, THROTTLE_BURST),
+    'invoice': (1 / THROTTLE_INVOICE_INTERVAL, THROTTLE_INVOICE_BURST),
+    'check': (0.5, 3),
+}
+
+# Действия с собственной корзиной; неизвестные команды и кнопки делят корзину default,
+# иначе произвольным текстом можно создать сколько угодно свежих корзин
+THROTTLE_COMMANDS = {'/start', '/admin', '/recount', '/broadcast'}
+THROTTLE_CALLBACKS = {'help', 'status', 'admin', 'bc'}
+
+logger = logging.getLogger(__name__)
+
+
+def action_for(event: TelegramObject) -> str:
+    """Тип действия: по нему выбираются квота и корзина"""
+    if isinstance(event, CallbackQuery):
+        data = event.data or ''
+        if data == 'buy_vpn':
+            return 'invoice'
+        if data.startswith('check_'):
+            return 'check'
+        prefix = data.split('_', 1)[0]
+        return 'callback:' + prefix if prefix in THROTTLE_CALLBACKS else 'default'
+    if isinstance(event, Message) and event.text and event.text.startswith('/'):
+        command = event.text.split()[0].split('@')[0]
+        return command if command in THROTTLE_COMMANDS else 'default'
+    return 'message'
+
+
+class TokenBuckets:
+    """Корзины токенов: {ключ: [токены, время последнего пополнения]}"""
+
+    def __init__(self, limits: dict, idle_ttl: float = THROTTLE_IDLE_TTL):
+        self.limits = limits
+        self.idle_ttl = idle_ttl
+        self._buckets: Dict[tuple, list] = {}
+        self._next_eviction = time.monotonic() + idle_ttl
+
+    def take(self, user_id: int, action: str) -> float:
+        """Списывает токен; возвращает 0, если действие разрешено, иначе секунды до следующего токена"""
+        rate, burst = self.limits.get(action, self.limits['default'])
+        now = time.monotonic()
+        if now >= self._next_eviction:
+            self.evict(now)
+        bucket = self._buckets.get((user_id, action))
+        if bucket is None:
+            self._buckets[(user_id, action)] = [burst - 1.0, now]
+            return 0.0
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+    def evict(self, now: Optional[float] = None):
+        """Удаляет корзины, не использовавшиеся дольше idle_ttl"""
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.idle_ttl
+        for key in [key for key, bucket in self._buckets.items() if bucket[1] < cutoff]:
+            del self._buckets[key]
+        self._next_eviction = now + self.idle_ttl
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Внешний middleware для message и callback_query: лишние обновления отбрасываются"""
+
+    def __init__(self, limits: dict = THROTTLE_LIMITS, exempt: tuple = ()):
+        self.buckets = TokenBuckets(limits)
+        self.exempt = set(exempt)
+        # Отклоненные обновления по типам действий
+        self.rejected: Dict[str, int] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = getattr(event, 'from_user', None)
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        action = action_for(event)
+        wait = self.buckets.take(user.id, action)
+        if not wait:
+            return await handler(event, data)
+
+        self.rejected[action] = self.rejected.get(action, 0) + 1
+        logger.info(f"🚦 {user.id}: {action} отклонено, повтор через {wait:.1f} с")
+        if isinstance(event, CallbackQuery):
+            # Ответ обязателен, иначе у кнопки будут крутиться "часики"
+            await event.answer(f"⏳ Слишком часто. Попробуйте через {max(int(wait + 0.999), 1)} сек.")
+        return None
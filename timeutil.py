@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Время в формате CURRENT_TIMESTAMP SQLite
+
+База хранит время строками 'YYYY-MM-DD HH:MM:SS' в UTC, а код работает с
+unix time. Перевод в обе стороны - здесь, чтобы модули не импортировали
+друг друга ради одной функции.
+"""
+
+from datetime import datetime, timezone
+
+SQLITE_TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_timestamp(value: str) -> float:
+    """CURRENT_TIMESTAMP SQLite (UTC) -> unix time"""
+    return datetime.strptime(value, SQLITE_TIMESTAMP).replace(tzinfo=timezone.utc).timestamp()
+
+
+def format_timestamp(value: float) -> str:
+    """unix time -> формат CURRENT_TIMESTAMP SQLite (UTC)"""
+    return datetime.fromtimestamp(value, timezone.utc).strftime(SQLITE_TIMESTAMP)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Реестр известных пользователей для /start
+
+Большинство /start присылают уже известные пользователи с тем же
+профилем, и запись в базу им не нужна. Реестр держит в памяти профили
+последних пользователей (прогревается из базы при старте, размер
+ограничен) и записывает только новых пользователей и реальные изменения
+username/first_name - пачкой раз в USER_FLUSH_INTERVAL секунд.
+"""
+
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from database import UsersRepository
+
+# Конфигурация
+USER_REGISTRY_SIZE = int(os.getenv('USER_REGISTRY_SIZE', '100000'))
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '2'))
+
+logger = logging.getLogger(__name__)
+
+
+class UserRegistry:
+    def __init__(
+        self,
+        users: UsersRepository,
+        maxsize: int = USER_REGISTRY_SIZE,
+        flush_interval: float = USER_FLUSH_INTERVAL
+    ):
+        self.users = users
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        # telegram_id -> (username, first_name), LRU
+        self._known: "OrderedDict[int, tuple]" = OrderedDict()
+        self._dirty: dict = {}
+        self._task = None
+        self.stats = {'skipped': 0, 'queued': 0, 'written': 0}
+
+    async def start(self):
+        """Прогревает реестр из базы и запускает периодическую запись"""
+        if self._task is not None:
+            return
+        rows = await self.users.get_profiles(self.maxsize)
+        for row in reversed(rows):
+            self._known[row['telegram_id']] = (row['username'], row['first_name'])
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"👥 Реестр пользователей прогрет: {len(self._known)}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def touch(self, telegram_id: int, username: Optional[str], first_name: Optional[str]):
+        """Отмечает пользователя; в базу попадут только новые пользователи и измененные профили"""
+        profile = (username, first_name)
+        if self._known.get(telegram_id) == profile:
+            self._known.move_to_end(telegram_id)
+            self.stats['skipped'] += 1
+            return
+        self._known[telegram_id] = profile
+        self._known.move_to_end(telegram_id)
+        while len(self._known) > self.maxsize:
+            self._known.popitem(last=False)
+        self._dirty[telegram_id] = profile
+        self.stats['queued'] += 1
+
+    def forget(self, telegram_id: int):
+        """Следующий /start пользователя снова попадет в базу (например, чтобы снять is_blocked)"""
+        self._known.pop(telegram_id, None)
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return 0
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self.users.upsert_many([(telegram_id, *profile) for telegram_id, profile in batch.items()])
+        except Exception:
+            # Вернем пачку, не затирая более свежие изменения
+            self._dirty = {**batch, **self._dirty}
+            raise
+        self.stats['written'] += len(batch)
+        return len(batch)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи пользователей: {e}")